@@ -0,0 +1,166 @@
+"""
+A benchmark of the whole import pipeline: AbstractImportTask.process, then
+ImportShard.process and _finalize_errors for every shard, then finish.
+
+A CSV file of the requested size is generated, and imported with the
+SynchronousExecutor and LocalStorage against whatever database Django is
+configured with (e.g. the local datastore stub). The rows aren't saved
+anywhere, so what's measured is the cost of osmosis itself.
+
+Run it with `manage.py osmosis_benchmark`, or call run_benchmark().
+"""
+
+import json
+import random
+import resource
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+import unicodecsv as csv
+from django import forms
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from osmosis import metrics
+from osmosis.executors import SynchronousExecutor
+from osmosis.models import ImportShard, ImportTask, ShardedCounter, _uses_datastore
+from osmosis.storage import LocalStorage
+
+SOURCE_FILENAME = "benchmark.csv"
+
+# The counters an import keeps, which are deleted along with it
+TASK_COUNTERS = (
+    "shards_processed", "shards_split", "shards_finalized", "shards_paused", "continuations",
+    "rows_imported", "rows_errored", "rows_counted", "finish_deferred",
+)
+
+
+def generate_csv(handle, rows, columns, error_rate=0.0, seed=0):
+    """
+    Write a CSV file of `rows` rows to `handle`. The first column is a number,
+    which is invalid in a `error_rate` fraction of the rows, and the rest are text.
+    """
+    generator = random.Random(seed)
+    errors = set(generator.sample(xrange(rows), int(rows * error_rate)))
+
+    writer = csv.writer(handle)
+    writer.writerow(["number"] + ["column%s" % i for i in xrange(1, columns)])
+    for row in xrange(rows):
+        number = "not a number" if row in errors else str(row)
+        writer.writerow([number] + [
+            "%s-%s" % (column, generator.randint(0, 1000000)) for column in xrange(1, columns)
+        ])
+
+
+def benchmark_form(columns):
+    """
+    A form for the files written by generate_csv
+    """
+    fields = {"number": forms.IntegerField()}
+    for i in xrange(1, columns):
+        fields["column%s" % i] = forms.CharField(max_length=100)
+    return type("BenchmarkForm", (forms.Form,), fields)
+
+
+class CountingExecutor(SynchronousExecutor):
+    """
+    A SynchronousExecutor which counts the tasks it runs
+    """
+    def __init__(self):
+        super(CountingExecutor, self).__init__()
+        self.counts = Counter()
+
+    def submit(self, kallable, *args, **kwargs):
+        instance = getattr(kallable, "im_self", None)
+        name = kallable.__name__ if instance is None else "%s.%s" % (type(instance).__name__, kallable.__name__)
+        self.counts[name] += 1
+        super(CountingExecutor, self).submit(kallable, *args, **kwargs)
+
+
+class BenchmarkImportTask(ImportTask):
+    class Meta:
+        proxy = True
+        app_label = "osmosis"
+
+    class Osmosis:
+        forms = []
+        generate_error_csv = True
+
+    def import_row(self, forms, cleaned_data):
+        pass
+
+    def open_source_data(self, start=0, end=None):
+        # The generated file is in our LocalStorage, not the default file storage
+        return self.get_storage().open(self.source_data.name, start, end)
+
+
+def _cleanup(task):
+    shards = ImportShard.objects.filter(task_id=task.pk, task_model_path=task.model_path)
+    for shard in shards:
+        shard.importsharderror_set.all().delete()
+    shards.delete()
+    # Including the history of the task class, so that one run doesn't size the shards of the next
+    ShardedCounter.clear(
+        [task._counter_name(name) for name in TASK_COUNTERS] +
+        [task._history_counter_name(name) for name in ("ms", "rows")]
+    )
+    task.delete()
+
+
+def run_benchmark(rows=10000, columns=10, error_rate=0.01, seed=0, **options):
+    """
+    Import a generated file and return a dict of measurements. Any other
+    keyword arguments are set as Osmosis options, e.g. rows_per_shard=500.
+    """
+    root = tempfile.mkdtemp()
+    meta = BenchmarkImportTask.get_meta()
+    previous = {name: getattr(meta, name) for name in list(options) + ["forms"]}
+    storage = LocalStorage(root)
+    executor = CountingExecutor()
+
+    try:
+        with storage.writer(SOURCE_FILENAME) as f:
+            generate_csv(f, rows, columns, error_rate, seed)
+
+        for name, value in options.items():
+            setattr(meta, name, value)
+        meta.forms = [benchmark_form(columns)]
+        meta._storage_instance = storage
+        meta._executor_instance = executor
+
+        memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        task = BenchmarkImportTask(source_data=SOURCE_FILENAME)
+        started = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            task.start()
+        elapsed = time.time() - started
+        memory_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        task = BenchmarkImportTask.objects.get(pk=task.pk)
+        summary = json.loads(task.metrics_json)
+        progress = task.progress()
+        try:
+            return {
+                "rows": progress["row_count"],
+                "rows_errored": progress["rows_errored"],
+                "shards": progress["shard_count"],
+                "seconds": elapsed,
+                "rows_per_second": progress["row_count"] / elapsed if elapsed else None,
+                # ru_maxrss is in kilobytes on Linux, and is the peak of the whole process
+                "peak_memory_mb": memory_after / 1024.0,
+                "peak_memory_increase_mb": (memory_after - memory_before) / 1024.0,
+                "datastore_calls": (
+                    summary["counts"].get(metrics.DATASTORE_CALLS, 0) if _uses_datastore() else len(queries)
+                ),
+                "tasks": dict(executor.counts),
+                "phase_seconds": summary["seconds"],
+            }
+        finally:
+            _cleanup(task)
+    finally:
+        for name, value in previous.items():
+            setattr(meta, name, value)
+        meta._storage_instance = meta._executor_instance = None
+        shutil.rmtree(root)
@@ -0,0 +1,241 @@
+"""
+Backends which run the steps of an import: AbstractImportTask.process,
+ImportShard.process, ImportShard._finalize_errors and AbstractImportTask.finish.
+
+The backend is chosen with Osmosis.executor. On App Engine the default,
+DeferredExecutor, runs each step as a deferred task. The others run an
+import without the task queue, in the current process or across a pool of
+threads or processes, which is useful for tests, batch jobs and profiling.
+"""
+
+import cPickle as pickle
+import functools
+import threading
+import traceback
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.db import connections
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+from osmosis.models import in_transaction, on_commit
+
+
+def _executor_kwargs(kwargs):
+    """
+    Remove the options meant for deferred.defer (_queue, _transactional, etc.)
+    """
+    return {k: v for k, v in kwargs.items() if not k.startswith("_")}
+
+
+class Executor(object):
+    """
+    Runs callables on behalf of an import. Callables submitted while
+    another one is running must not run inside it, as they're often
+    submitted from inside a transaction.
+    """
+    def submit(self, kallable, *args, **kwargs):
+        raise NotImplementedError()
+
+    def submit_many(self, kallables, queue=None):
+        for kallable in kallables:
+            self.submit(kallable, _queue=queue)
+
+    def join(self):
+        """
+        Wait until everything submitted (and everything they submit) has run
+        """
+        pass
+
+
+class DeferredExecutor(Executor):
+    """
+    Runs each callable as a task on the App Engine task queue
+    """
+    def submit(self, kallable, *args, **kwargs):
+        deferred.defer(kallable, *args, **kwargs)
+
+    def submit_many(self, kallables, queue=None):
+        """
+        Add the callables to the queue in as few calls as possible
+        """
+        queue = taskqueue.Queue(queue or deferred.deferred._DEFAULT_QUEUE)
+        tasks = [
+            taskqueue.Task(
+                payload=deferred.deferred.serialize(kallable),
+                url=deferred.deferred._DEFAULT_URL,
+                headers=deferred.deferred._TASKQUEUE_HEADERS
+            )
+            for kallable in kallables
+        ]
+
+        for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+class SynchronousExecutor(Executor):
+    """
+    Runs everything in the current thread. The first submission runs straight
+    away, anything it submits is queued and run after it returns, so the whole
+    import has finished when the outermost submit() returns. Anything submitted
+    inside a transaction is only queued (or run) once the transaction commits.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def submit(self, kallable, *args, **kwargs):
+        submission = (kallable, args, _executor_kwargs(kwargs))
+        if in_transaction():
+            # Not inside the caller's transaction, and not at all if it fails
+            on_commit(functools.partial(self._run, submission))
+        else:
+            self._run(submission)
+
+    def _run(self, submission):
+        queue = getattr(self.local, "queue", None)
+        if queue is not None:
+            queue.append(submission)
+            return
+
+        self.local.queue = [submission]
+        try:
+            while self.local.queue:
+                kallable, args, kwargs = self.local.queue.pop(0)
+                kallable(*args, **kwargs)
+        finally:
+            self.local.queue = None
+
+
+class ThreadPoolExecutor(Executor):
+    """
+    Runs callables on a pool of threads. Call join() to wait for the import to finish.
+    Exceptions are collected in `errors` rather than raised. Anything submitted inside
+    a transaction is only handed to the pool once the transaction commits.
+    """
+    pool_class = ThreadPool
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.pool = None
+        self.pending = 0
+        self.errors = []
+        self.condition = threading.Condition()
+
+    def _get_pool(self):
+        with self.condition:
+            if self.pool is None:
+                self.pool = self.pool_class(self.max_workers)
+            return self.pool
+
+    def _started(self):
+        with self.condition:
+            self.pending += 1
+
+    def _finished(self, error=None):
+        with self.condition:
+            if error:
+                self.errors.append(error)
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def _run(self, kallable, args, kwargs):
+        error = None
+        try:
+            kallable(*args, **kwargs)
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            self._finished(error)
+
+    def _apply(self, submission):
+        self._started()
+        self._get_pool().apply_async(self._run, submission)
+
+    def submit(self, kallable, *args, **kwargs):
+        # If we're in a transaction, the pool mustn't see it before it commits (or at all if it fails)
+        on_commit(functools.partial(self._apply, (kallable, args, _executor_kwargs(kwargs))))
+
+    def join(self):
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+
+# Set in the worker processes of a ProcessPoolExecutor, to collect what
+# the running callable submits so it can be sent back to the parent
+_worker_submissions = None
+
+
+def _pack(kallable, args, kwargs):
+    """
+    Pickle a callable and its arguments. Bound methods can't be pickled
+    directly, so they're stored as the instance and the method name.
+    """
+    instance = getattr(kallable, "im_self", None)
+    if instance is not None:
+        return pickle.dumps((instance, kallable.__name__, args, kwargs), pickle.HIGHEST_PROTOCOL)
+    return pickle.dumps((None, kallable, args, kwargs), pickle.HIGHEST_PROTOCOL)
+
+
+def _unpack(payload):
+    instance, kallable, args, kwargs = pickle.loads(payload)
+    if instance is not None:
+        kallable = getattr(instance, kallable)
+    return kallable, args, kwargs
+
+
+def _init_worker():
+    # Don't share the parent's database connections
+    for connection in connections.all():
+        connection.close()
+
+
+def _run_in_worker(payload):
+    """
+    Run a packed callable, returning what it submitted and any error
+    """
+    global _worker_submissions
+    _worker_submissions = []
+    error = None
+    try:
+        kallable, args, kwargs = _unpack(payload)
+        kallable(*args, **kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    submissions, _worker_submissions = _worker_submissions, None
+    return submissions, error
+
+
+class ProcessPoolExecutor(ThreadPoolExecutor):
+    """
+    Runs callables on a pool of processes, so an import can use every core.
+    Anything a worker submits is sent back to this process to be scheduled.
+    The workers need a database they can all connect to, so an in-memory
+    SQLite database won't do.
+    """
+    def _get_pool(self):
+        with self.condition:
+            if self.pool is None:
+                self.pool = Pool(self.max_workers, initializer=_init_worker)
+            return self.pool
+
+    def _collect(self, result):
+        submissions, error = result
+        for payload in submissions:
+            self._submit_packed(payload)
+        self._finished(error)
+
+    def _submit_packed(self, payload):
+        self._started()
+        self._get_pool().apply_async(_run_in_worker, (payload,), callback=self._collect)
+
+    def submit(self, kallable, *args, **kwargs):
+        payload = _pack(kallable, args, _executor_kwargs(kwargs))
+        if _worker_submissions is not None:
+            # We're in a worker, let the parent schedule it
+            schedule = functools.partial(_worker_submissions.append, payload)
+        else:
+            schedule = functools.partial(self._submit_packed, payload)
+        # As with threads, only once the transaction it's submitted in commits
+        on_commit(schedule)
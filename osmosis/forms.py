@@ -1,4 +1,10 @@
+import copy
+
 from django import forms
+from django.core.exceptions import ValidationError
+
+# The datastore limits how many values an IN filter can have, other than on the primary key
+LOOKUP_BATCH_SIZE = 30
 
 
 class BooleanInterpreterMixin(object):
@@ -17,3 +23,116 @@ class BooleanInterpreterMixin(object):
                 field_name not in explicit_widgets # don't alter widgets which have been manually specified
             ):
                 field.widget = forms.Widget()
+
+
+# Classes whose __init__ only sets up state which FormPrototype.bind resets
+REBINDABLE_INIT_CLASSES = (object, forms.BaseForm, forms.BaseModelForm, BooleanInterpreterMixin)
+
+
+def can_rebind(form_class):
+    """ Whether copies of a single instance of form_class can be used in place of building a
+        new form for each row. That isn't the case if a subclass overrides __init__, because it
+        might depend on the data.
+    """
+    return all(
+        klass in REBINDABLE_INIT_CLASSES or "__init__" not in vars(klass)
+        for klass in form_class.__mro__
+    )
+
+
+class LookupCache(object):
+    """ Resolves the values of a ModelChoiceField for many rows at once. prefetch() looks up the
+        distinct values of a batch of rows with one query (per LOOKUP_BATCH_SIZE values), and
+        to_python, which replaces the field's, returns the cached instances. Anything which
+        wasn't prefetched, or wasn't found, goes through the field's own to_python as usual.
+    """
+    def __init__(self, field, name):
+        self.field = field
+        self.name = name
+        self.lookup = field.to_field_name or "pk"
+        opts = field.queryset.model._meta
+        self.model_field = opts.pk if self.lookup == "pk" else opts.get_field(self.lookup)
+        self.original_to_python = field.to_python
+        self.instances = {}
+        self.fetched = set()
+
+    def _key(self, value):
+        """ The value as it would be stored on the model, or None if it can't be cached """
+        if value in self.field.empty_values:
+            return None
+        try:
+            key = self.model_field.to_python(value)
+            hash(key)
+        except (ValidationError, TypeError, ValueError):
+            return None
+        return key
+
+    def prefetch(self, rows):
+        keys = set()
+        for row in rows:
+            key = self._key(self.field.widget.value_from_datadict(row, {}, self.name))
+            if key is not None and key not in self.fetched:
+                keys.add(key)
+
+        keys = list(keys)
+        batch_size = len(keys) if self.model_field.primary_key else LOOKUP_BATCH_SIZE
+        for i in xrange(0, len(keys), batch_size or 1):
+            batch = keys[i:i + batch_size]
+            for instance in self.field.queryset.filter(**{"%s__in" % self.lookup: batch}):
+                self.instances[getattr(instance, self.model_field.attname)] = instance
+            self.fetched.update(batch)
+
+    def to_python(self, value):
+        key = self._key(value)
+        if key is not None and key in self.instances:
+            return self.instances[key]
+        return self.original_to_python(value)
+
+
+def can_prefetch(field):
+    """ Whether the field is a ModelChoiceField which LookupCache can stand in for """
+    return (
+        isinstance(field, forms.ModelChoiceField) and
+        not isinstance(field, forms.ModelMultipleChoiceField) and
+        type(field).to_python.__func__ is forms.ModelChoiceField.to_python.__func__
+    )
+
+
+class FormPrototype(object):
+    """ Builds a form once, and then makes shallow copies of it bound to each row of data.
+        The copies share the prototype's fields and widgets, which avoids deep copying
+        base_fields (and any widget swaps done in __init__) for every row. Validation still
+        goes through the normal full_clean, so clean methods behave exactly as they would
+        on a new form.
+
+        The prototype's ModelChoiceFields get a LookupCache, so that prefetch() can look up
+        the values of many rows at once.
+    """
+    def __init__(self, form_class):
+        self.form = form_class()
+        self.lookups = []
+        for name, field in self.form.fields.items():
+            if can_prefetch(field):
+                lookup = LookupCache(field, self.form.add_prefix(name))
+                field.to_python = lookup.to_python
+                self.lookups.append(lookup)
+
+    def __call__(self, data):
+        return self.bind(data)
+
+    def prefetch(self, rows):
+        """ Look up the ModelChoiceField values of the rows, one query per field """
+        for lookup in self.lookups:
+            lookup.prefetch(rows)
+
+    def bind(self, data):
+        form = copy.copy(self.form)
+        form.is_bound = True
+        form.data = data
+        form.files = {}
+        form._errors = None
+        form._changed_data = None
+        form._bound_fields_cache = {}
+        if isinstance(form, forms.BaseModelForm):
+            form.instance = form._meta.model()
+        return form
@@ -0,0 +1,39 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from osmosis.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Import a generated CSV file and report how fast it went, see osmosis.benchmark"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--rows", type="int", default=10000, help="Number of rows in the file"),
+        make_option("--columns", type="int", default=10, help="Number of columns in the file"),
+        make_option("--error-rate", type="float", default=0.01, help="Fraction of the rows which are invalid"),
+        make_option("--seed", type="int", default=0, help="Seed for generating the file"),
+        make_option(
+            "--set", action="append", default=[], metavar="NAME=VALUE",
+            help="Set an Osmosis option, the value is JSON (e.g. --set rows_per_shard=500)"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        settings = {}
+        for setting in options["set"]:
+            name, _, value = setting.partition("=")
+            try:
+                settings[name] = json.loads(value)
+            except ValueError:
+                raise CommandError("The value of %s must be JSON" % name)
+
+        results = run_benchmark(
+            rows=options["rows"],
+            columns=options["columns"],
+            error_rate=options["error_rate"],
+            seed=options["seed"],
+            **settings
+        )
+        self.stdout.write(json.dumps(results, indent=4, sort_keys=True))
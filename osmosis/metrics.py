@@ -0,0 +1,187 @@
+"""
+Instrumentation of imports: how long each phase takes, how many rows were
+processed and how many datastore calls were made.
+
+Each part of an import (the task's process, each shard and finish) collects
+Timings, which are stored on the shard or task as they go. When the import
+finishes the totals are summarised in AbstractImportTask.metrics_json. As
+the timings are recorded they are also passed to the sink chosen with
+Osmosis.metrics, which can forward them to a monitoring system.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from google.appengine.api import apiproxy_stub_map
+
+# Phases
+PARSE = "parse"  # Reading rows from the source file
+CREATE_SHARDS = "create_shards"
+QUEUE = "queue"  # From a shard being queued to it starting
+PREFETCH = "prefetch"  # Looking up the values of ModelChoiceField columns
+VALIDATE = "validate"  # Building the forms and validating them
+IMPORT = "import"  # import_row or import_rows
+CHECKPOINT = "checkpoint"
+WRITE_ERRORS = "write_errors"
+FINISH = "finish"
+
+# Counts
+ROWS = "rows"
+DATASTORE_CALLS = "datastore_calls"
+SHARD_TASKS = "shard_tasks"
+
+
+class Timings(object):
+    """
+    Seconds spent in each phase, and counts of things like rows. `started`
+    is when the import started, if these are the timings for all of it.
+    """
+    def __init__(self, seconds=None, counts=None, started=None):
+        self.seconds = defaultdict(float, seconds or {})
+        self.counts = defaultdict(int, counts or {})
+        self.started = started
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def timed(self, name, iterable):
+        """
+        Iterate over `iterable`, adding the time spent getting each item to phase `name`
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def take(self):
+        """
+        Return a copy of these timings, and reset them
+        """
+        taken = Timings(self.seconds, self.counts, self.started)
+        self.seconds.clear()
+        self.counts.clear()
+        return taken
+
+    def add(self, name, seconds):
+        self.seconds[name] += seconds
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def merge(self, other):
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+        for name, count in other.counts.items():
+            self.counts[name] += count
+        if other.started is not None:
+            self.started = other.started if self.started is None else min(self.started, other.started)
+        return self
+
+    def __nonzero__(self):
+        return bool(self.seconds or self.counts)
+
+    def to_dict(self):
+        data = {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+        if self.started is not None:
+            data["started"] = self.started
+        return data
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Load timings stored with to_json() or summary()
+        """
+        data = json.loads(data) if data else {}
+        return cls(data.get("seconds"), data.get("counts"), data.get("started"))
+
+    def summary(self, finished=None):
+        """
+        A dict of the timings along with the import's throughput
+        """
+        summary = self.to_dict()
+        rows = self.counts[ROWS]
+
+        busy = sum(seconds for name, seconds in self.seconds.items() if name != QUEUE)
+        summary["busy_seconds"] = busy
+        if self.started is not None and finished is not None:
+            summary["elapsed_seconds"] = finished - self.started
+            if finished > self.started:
+                summary["rows_per_second"] = rows / (finished - self.started)
+        if rows:
+            summary["datastore_calls_per_row"] = float(self.counts[DATASTORE_CALLS]) / rows
+        if self.counts[SHARD_TASKS]:
+            summary["queue_latency_seconds"] = self.seconds[QUEUE] / self.counts[SHARD_TASKS]
+        return summary
+
+
+_local = threading.local()
+
+
+def _count_datastore_call(service, call, request, response):
+    counter = getattr(_local, "datastore_calls", None)
+    if counter is not None:
+        counter.calls += 1
+
+
+class DatastoreCalls(object):
+    """
+    Counts the datastore RPCs made by the current thread, from when it's created
+    until another DatastoreCalls is created on the thread. On other databases
+    nothing is counted.
+    """
+    def __init__(self):
+        # Append does nothing if the hook is already installed
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            "osmosis_metrics", _count_datastore_call, "datastore_v3"
+        )
+        self.calls = 0
+        _local.datastore_calls = self
+
+    def take(self):
+        """
+        Return the number of calls since the last take(), and reset it
+        """
+        calls, self.calls = self.calls, 0
+        return calls
+
+
+class Metrics(object):
+    """
+    A sink for the timings of imports, which does nothing with them
+    """
+    def record(self, task, timings, shard=None):
+        """
+        Called with the timings since the last call for the same part of the
+        import: the task's process (`shard` is None), a shard, or finish
+        """
+        pass
+
+    def finished(self, task, summary):
+        """
+        Called by finish with the summary of the whole import
+        """
+        pass
+
+
+class LoggingMetrics(Metrics):
+    """
+    Logs the summary of each import
+    """
+    def finished(self, task, summary):
+        logging.info("Import %s %s finished: %s", task.model_path, task.pk, json.dumps(summary, sort_keys=True))
@@ -1,9 +1,19 @@
+import functools
+import itertools
 import json
+import random
+import StringIO
+import threading
+import time
 import unicodecsv as csv
+from collections import OrderedDict
 
+from django import forms as django_forms
 from django.apps import apps
 from django.db import models
+from django.db.models import signals
 from django.db import connections
+from django.db import IntegrityError
 from django.db import transaction
 
 from django.core.exceptions import ValidationError
@@ -12,10 +22,15 @@ from importlib import import_module
 from google.appengine.ext import deferred
 from google.appengine.ext import db
 
-from google.appengine.api.app_identity import get_default_gcs_bucket_name
-from google.appengine.ext.blobstore import BlobInfo, create_gs_key
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext.blobstore import BlobInfo
 
-import cloudstorage
+from osmosis import metrics
+from osmosis.forms import can_rebind, FormPrototype
+from osmosis.payload import decode_columns, decode_rows, encode_rows
+from osmosis.readers import dialect_attributes, get_reader_class, READ_ERROR_KEY, SNIFF_SAMPLE_SIZE
+from osmosis.unique import DUPLICATE_ERROR, DuplicateDetector, UniqueKey
 
 try:
     from djangae.storage import BlobstoreFile, BlobstoreStorage
@@ -23,31 +38,171 @@ except ImportError:
     from djangoappengine.storage import BlobstoreFile, BlobstoreStorage
 
 
+def _uses_datastore():
+    return "djangoappengine" in unicode(connections['default']) or \
+        "djangae" in unicode(connections['default'])
+
+
+def _bulk_insert_returns_ids(model):
+    # Django only sets the pks of the instances passed to bulk_create on backends which return them
+    return getattr(connections[model.objects.db].features, "can_return_ids_from_bulk_insert", False)
+
+
+def _allocate_ids(model, count):
+    """
+    Reserve the pks of `count` new instances of `model`, so that they're known before
+    they're inserted with bulk_create. Returns None if the database can't do that.
+    """
+    if not _uses_datastore():
+        return None
+    start, end = db.allocate_ids(db.Key.from_path(model._meta.db_table, 1), count)
+    return range(start, end + 1)
+
+
+# The callbacks to run once the transaction this thread is in commits, see on_commit
+_transaction_state = threading.local()
+
+
+def in_transaction():
+    """
+    Whether this thread is inside a function decorated with transactional
+    """
+    return getattr(_transaction_state, "callbacks", None) is not None
+
+
+def on_commit(callback):
+    """
+    Call `callback` once the transaction we're in has been committed, or straight
+    away if we aren't in one. It isn't called if the transaction fails.
+    """
+    if in_transaction():
+        _transaction_state.callbacks.append(callback)
+    else:
+        callback()
+
+
 def transactional(func):
-    if "djangoappengine" in unicode(connections['default']) or \
-        "djangae" in unicode(connections['default']):
+    def attempt(*args, **kwargs):
+        # The datastore retries transactions which collide, so start each attempt afresh
+        _transaction_state.callbacks = []
+        return func(*args, **kwargs)
+
+    if _uses_datastore():
+        attempt = db.transactional(xg=True)(attempt)
+    else:
+        attempt = transaction.commit_on_success(attempt)
+
+    @functools.wraps(func)
+    def _wrapped(*args, **kwargs):
+        if in_transaction():
+            return func(*args, **kwargs)  # Part of the transaction we're already in
 
-        @db.transactional(xg=True)
-        def _wrapped(*args, **kwargs):
-            return func(*args, **kwargs)
+        try:
+            result = attempt(*args, **kwargs)
+            callbacks = _transaction_state.callbacks
+        finally:
+            _transaction_state.callbacks = None
+
+        for callback in callbacks:
+            callback()
+        return result
 
-        return _wrapped
+    return _wrapped
+
+
+def _validation_error_messages(e):
+    """
+    Flatten a ValidationError into a list of "field: message" strings
+    """
+    errors = []
+    if hasattr(e, 'message_dict'):
+        for name, errs in e.message_dict.items():
+            for err in errs:
+                errors.append("{0}: {1}".format(name, err))
     else:
-        @transaction.commit_on_success
-        def _wrapped(*args, **kwargs):
-            return func(*args, **kwargs)
+        # Pre 1.6, ValidationError does not necessarily have a message_dict
+        for err in e.messages:
+            errors.append(err)
+    return errors
+
+
+def _load_dialect(dialect_json):
+    """
+    Load a dialect dict stored with json.dumps. The csv module
+    won't accept unicode for single character dialect attributes
+    """
+    return {
+        k: str(v) if isinstance(v, unicode) else v
+        for k, v in json.loads(dialect_json).items()
+    }
+
+
+def _import_path(path):
+    module, klass = path.rsplit(".", 1)
+    return getattr(import_module(module), klass)
+
+
+def _load_backend(backend):
+    """
+    An instance of `backend`, which can be an instance, a class or the path to one
+    """
+    if isinstance(backend, basestring):
+        backend = _import_path(backend)
+    if isinstance(backend, type):
+        backend = backend()
+    return backend
+
+
+def _meta_cached(meta, name, load):
+    """
+    The value of `load()`, cached on `meta` as `name`. Only a value set on `meta` itself
+    counts, so an Osmosis which subclasses another doesn't share its parent's.
+    """
+    value = vars(meta).get(name)
+    if value is None:
+        value = load()
+        setattr(meta, name, value)
+    return value
+
 
-        return _wrapped
+# The last column of the error CSV
+ERRORS_COLUMN = "errors"
+
+# How long a task's status is cached in memcache for the shards to check
+STATUS_CACHE_SECONDS = 10 * 60
+
+# How long resume() waits before looking again for paused shards its query missed
+UNPAUSE_RETRY_SECONDS = 5
+
+# How often a shard adds the time it has taken to the history used by
+# Osmosis.target_shard_seconds, as well as when it reaches its last row
+HISTORY_SAMPLE_SECONDS = 60
+
+
+class ShardSource(object):
+    """
+    How the source rows of each shard are stored
+    """
+    JSON = "json"  # The rows are copied into ImportShard.source_data_json
+    BYTE_RANGE = "byte_range"  # Only the start and end offsets in the source file are stored
 
 
 class ImportStatus(object):
     PENDING = "pending"
     IN_PROGRESS = "in_progress"
+    PAUSED = "paused"
+    CANCELLED = "cancelled"
     FINISHED = "finished"
 
     @classmethod
     def choices(cls):
-        return (ImportStatus.PENDING, "Pending"), (ImportStatus.IN_PROGRESS, "In Progress"), (ImportStatus.FINISHED, "Finished")
+        return (
+            (ImportStatus.PENDING, "Pending"),
+            (ImportStatus.IN_PROGRESS, "In Progress"),
+            (ImportStatus.PAUSED, "Paused"),
+            (ImportStatus.CANCELLED, "Cancelled"),
+            (ImportStatus.FINISHED, "Finished"),
+        )
 
 
 class AbstractImportTask(models.Model):
@@ -61,17 +216,27 @@ class AbstractImportTask(models.Model):
     row_count = models.PositiveIntegerField(default=0, editable=False)
     shard_count = models.PositiveIntegerField(default=0, editable=False)
     shards_processed = models.PositiveIntegerField(default=0, editable=False)
-    # This field is here because we don't have foreign key relation anymore and
-    # retrieving this from ImportShard wasn't possible due to transaction
-    shards_error_csv_written = models.BooleanField(default=False, editable=False)
 
     status = models.CharField(max_length=32, choices=ImportStatus.choices(), default=ImportStatus.PENDING, editable=False)
 
+    # Stored so that shards can parse their own part of the source file
+    detected_columns_json = models.TextField(default="", editable=False)
+    detected_dialect_json = models.TextField(default="", editable=False)
+
+    # See osmosis.metrics
+    metrics_json = models.TextField(default="", editable=False)
+
+    # Set by start(dry_run=True)
+    dry_run = models.BooleanField(default=False, editable=False)
+    # Set on the tasks created by retry_errors, to the task whose errors they import
+    retry_of_id = models.PositiveIntegerField(null=True, editable=False)
+
     class Meta:
         abstract = True
 
     def __init__(self, *args, **kwargs):
         super(AbstractImportTask, self).__init__(*args, **kwargs)
+        self.current_shard = None  # The shard calling handle_error
         if not self.model_path:
             self.model_path = ".".join([self._meta.app_label, self.__class__.__name__])
 
@@ -82,6 +247,68 @@ class AbstractImportTask(models.Model):
         queue = deferred.deferred._DEFAULT_QUEUE
         error_csv_subdirectory = "osmosis-errors"
         shard_model = "osmosis.ImportShard"
+        # How often ImportShard.process records its progress. A checkpoint is written
+        # after every `checkpoint_rows` rows, or once `checkpoint_seconds` have passed
+        # since the last one (whichever comes first). If a shard task is retried, only
+        # the rows processed since the last checkpoint will be imported again.
+        checkpoint_rows = 1
+        checkpoint_seconds = None
+        # If set, valid rows are collected and passed to import_rows() in batches of
+        # this size rather than calling import_row() for each one
+        import_batch_size = None
+        # ShardSource.BYTE_RANGE stores only the byte offsets of each shard's rows,
+        # and the shard re-reads them from the source file when it is processed
+        shard_source = ShardSource.JSON
+        # If set with ShardSource.BYTE_RANGE, the file is split into shards of roughly this
+        # many bytes by looking for row boundaries, instead of being parsed by the coordinator
+        bytes_per_shard = None
+        # Compress the rows stored in ImportShard.source_data_json with zlib
+        compress_shards = False
+        # Build each form once per shard and copy it for every row, rather than
+        # instantiating it from scratch. Forms which override __init__ are always
+        # built for each row, as is everything if instantiate_form is overridden.
+        reuse_forms = True
+        # If set, rows_per_shard is chosen so that each shard takes roughly this many
+        # seconds, based on previous imports of this task class or, failing that, by
+        # timing the validation of the first adaptive_sample_rows rows. A shard which
+        # runs for shard_split_factor times longer moves its remaining rows to a new shard.
+        target_shard_seconds = None
+        adaptive_sample_rows = 20
+        max_rows_per_shard = 10000
+        shard_split_factor = 2
+        # A shard which has been running this long checkpoints and re-defers itself,
+        # rather than running into the request deadline. None to disable.
+        shard_deadline_seconds = 9 * 60
+        # Rows are read this many at a time so that the values of their ModelChoiceField
+        # columns can be looked up together, with one query per column rather than one per
+        # row. Only applies to forms which are built once per shard (see reuse_forms).
+        # None to look up each row's values as it's validated.
+        lookup_prefetch_rows = 1000
+        # The names of the columns which identify the entity each row is for, see osmosis.unique.
+        # The existing instances of the model of the first ModelForm in `forms` are looked up
+        # for each batch of rows (of lookup_prefetch_rows), and the forms update them rather
+        # than creating new ones. With detect_duplicates, a row is reported as an error if another
+        # row of the file has claimed its key (whichever shard got to it first, not necessarily
+        # the earlier line).
+        unique_key = None
+        detect_duplicates = True
+        # What runs each step of the import, see osmosis.executors
+        executor = "osmosis.executors.DeferredExecutor"
+        # Where the source file is read from and the error CSVs are written, see osmosis.storage
+        storage = "osmosis.storage.CloudStorage"
+        # The osmosis.readers.SourceReader class (or path to one) which parses the source
+        # file. By default it's picked by the file's extension, falling back to CSV.
+        source_reader = None
+        # The CSV dialect of the source file, as a csv.Dialect or a dict of the attributes which
+        # differ from csv.excel. If not set it's sniffed from the first sniff_sample_size bytes.
+        # Either way it's stored on the task, and used for the error CSV too.
+        dialect = None
+        sniff_sample_size = SNIFF_SAMPLE_SIZE
+        # Where the timings of each part of the import are sent, see osmosis.metrics
+        metrics = "osmosis.metrics.Metrics"
+        # How often a running shard checks whether the import has been paused or cancelled,
+        # writing a checkpoint before it stops. The status is cached in memcache, so checking is cheap.
+        status_check_seconds = 5
 
     @classmethod
     def required_fields(cls):
@@ -131,7 +358,7 @@ class AbstractImportTask(models.Model):
         """
         meta = getattr(cls, "Osmosis")
 
-        if not hasattr(meta, "_initialised"):
+        if not vars(meta).get("_initialised"):
 
             for attr in (x for x in dir(AbstractImportTask.Osmosis) if not x.startswith("_")):
                 if not hasattr(meta, attr):
@@ -154,19 +381,201 @@ class AbstractImportTask(models.Model):
 
     @classmethod
     def get_shard_model(cls):
-        shard_model = cls.get_meta().shard_model.split('.')
-        return apps.get_model(app_label=shard_model[0], model_name=shard_model[1])
+        meta = cls.get_meta()
+        return _meta_cached(meta, "_shard_model_class", lambda: apps.get_model(*meta.shard_model.split('.')))
+
+    @classmethod
+    def get_executor(cls):
+        """
+        The osmosis.executors.Executor from Osmosis.executor, which can be
+        an instance, a class or the path to one
+        """
+        meta = cls.get_meta()
+        return _meta_cached(meta, "_executor_instance", lambda: _load_backend(meta.executor))
+
+    @classmethod
+    def get_storage(cls):
+        """
+        The osmosis.storage.Storage from Osmosis.storage, which can be
+        an instance, a class or the path to one
+        """
+        meta = cls.get_meta()
+        return _meta_cached(meta, "_storage_instance", lambda: _load_backend(meta.storage))
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        The osmosis.metrics.Metrics from Osmosis.metrics, which can be
+        an instance, a class or the path to one
+        """
+        meta = cls.get_meta()
+        return _meta_cached(meta, "_metrics_instance", lambda: _load_backend(meta.metrics))
+
+    @classmethod
+    def get_unique_key(cls):
+        """
+        The osmosis.unique.UniqueKey for Osmosis.unique_key, or None
+        """
+        meta = cls.get_meta()
+        if not meta.unique_key:
+            return None
+
+        model = next(
+            (form._meta.model for form in meta.forms if issubclass(form, django_forms.BaseModelForm)), None
+        )
+        return UniqueKey(meta.unique_key, model)
+
+    def get_source_reader_class(self):
+        """
+        The osmosis.readers.SourceReader for the source file
+        """
+        reader = self.get_meta().source_reader
+        if reader is None:
+            return get_reader_class(getattr(self.source_data, "name", None))
+        if isinstance(reader, basestring):
+            return _import_path(reader)
+        return reader
+
+    def get_dialect(self):
+        """
+        The dialect of the source file from Osmosis.dialect, or the one detected
+        when the file was first read. None if it hasn't been read yet.
+        """
+        meta = self.get_meta()
+        if meta.dialect:
+            return dialect_attributes(meta.dialect)
+        if self.detected_dialect_json:
+            return _load_dialect(self.detected_dialect_json)
+        return None
+
+    def open_source_data(self, start=0, end=None):
+        """
+        Open the source file, positioned at `start`. Reading may stop at `end`.
+        """
+        return self.get_storage().open_source(self.source_data, start, end)
 
     def defer(self, kallable, *args, **kwargs):
         kwargs['_queue'] = self.get_meta().queue
-        deferred.defer(kallable, *args, **kwargs)
+        self.get_executor().submit(kallable, *args, **kwargs)
 
-    def start(self):
+    def defer_many(self, kallables):
+        """
+        Defer several callables at once, on the task queue this uses as few calls as possible
+        """
+        self.get_executor().submit_many(kallables, queue=self.get_meta().queue)
+
+    def start(self, dry_run=False):
+        """
+        Start the import. A dry run only validates the rows: the error CSV and the counts
+        in progress() are produced as usual, but nothing is passed to import_row(s).
+        """
+        self.dry_run = dry_run
         self.save()  # Make sure we are saved before processing
 
         self.row_columns = None
         self.defer(self.process)
 
+    def _status_cache_key(self):
+        return "osmosis-status:%s:%s" % (self.model_path, self.pk)
+
+    def current_status(self):
+        """
+        The status of the task, from memcache if it's there so that shards can check it cheaply
+        """
+        status = memcache.get(self._status_cache_key())
+        if status is None:
+            status = self.__class__.objects.filter(pk=self.pk).values_list("status", flat=True).first() or self.status
+            # Don't overwrite a change made since we read it
+            memcache.add(self._status_cache_key(), status, time=STATUS_CACHE_SECONDS)
+        return status
+
+    def _change_status(self, status, from_statuses):
+        """
+        Set the status if it's currently one of `from_statuses`. Returns whether it was changed.
+        """
+        @transactional
+        def change_status(task):
+            task = self.__class__.objects.get(pk=task.pk)
+            if task.status not in from_statuses:
+                return False
+            task.status = status
+            task.save()
+            return True
+
+        changed = change_status(self)
+        if changed:
+            self.status = status
+            memcache.set(self._status_cache_key(), status, time=STATUS_CACHE_SECONDS)
+        return changed
+
+    def pause(self):
+        """
+        Stop the shards at their next checkpoint, until resume() is called.
+        Returns False if the import isn't pending or in progress.
+        """
+        return self._change_status(ImportStatus.PAUSED, (ImportStatus.PENDING, ImportStatus.IN_PROGRESS))
+
+    def resume(self):
+        """
+        Queue the paused shards to carry on from their last checkpoints, from a task as there may be
+        lots of them. Shards which were still on their way to a checkpoint carry on by themselves,
+        as do those which hadn't started. Returns False if the import isn't paused.
+        """
+        if not self._change_status(ImportStatus.IN_PROGRESS, (ImportStatus.PAUSED,)):
+            return False
+
+        self.defer(self._queued_copy()._unpause_shards)
+        return True
+
+    def _unpause_shards(self):
+        """
+        Queue the paused shards. The query for them can be out of date on the datastore, so
+        if the shards_paused counter says some were missed, this is deferred to look again.
+        """
+        if self.__class__.objects.get(pk=self.pk).status != ImportStatus.IN_PROGRESS:
+            return  # Paused again or cancelled, resume() will be called again if need be
+
+        shards = self.get_shard_model().objects.filter(task_id=self.pk, task_model_path=self.model_path, paused=True)
+        unpaused = [shard for shard in shards if shard._unpause(self)]
+        self.defer_many([shard._queued_copy().process for shard in unpaused])
+
+        paused_name = self._counter_name("shards_paused")
+        if ShardedCounter.totals([paused_name])[paused_name] > 0:
+            self.defer(self._queued_copy()._unpause_shards, _countdown=UNPAUSE_RETRY_SECONDS)
+
+    def cancel(self):
+        """
+        Stop the import for good, each shard stops at its next checkpoint. The
+        rows imported so far are left as they are, and finish() isn't called.
+        Returns False if the import has already finished or been cancelled.
+        """
+        return self._change_status(
+            ImportStatus.CANCELLED, (ImportStatus.PENDING, ImportStatus.IN_PROGRESS, ImportStatus.PAUSED)
+        )
+
+    def retry_errors(self, corrected_file=None, dry_run=False):
+        """
+        Start a new task which imports just the rows that failed in this (finished) one, with
+        their original line numbers. The rows are those stored when the errors were found, or
+        if `corrected_file` is given, those of a corrected copy of the error CSV. The line
+        numbers of a corrected file can only be kept if it still has a row for each error, in
+        the same order. Returns the new task.
+        """
+        if self.status != ImportStatus.FINISHED:
+            raise ValueError("Only finished imports can be retried")
+        if not self.detected_columns_json:
+            raise ValueError("The columns of this import weren't stored, so its errors can't be retried")
+
+        task = self.__class__(
+            retry_of_id=self.pk,
+            detected_columns_json=self.detected_columns_json,
+            detected_dialect_json=self.detected_dialect_json,
+        )
+        if corrected_file is not None:
+            task.source_data = corrected_file
+        task.start(dry_run=dry_run)
+        return task
+
     def next_source_row(self, handle):
         """
         Given a file handle, return the next row of data as a key value dict.
@@ -175,118 +584,465 @@ class AbstractImportTask(models.Model):
         Return False to skip this row of data entirely
         """
 
-        if not getattr(self, "detected_dialect", None):
-            # Sniff for the dialect of the CSV file
-
-            pos = handle.tell()
-            handle.seek(0)
-            readahead = handle.read(1024)
-            handle.seek(pos)
-
-            try:
-                dialect = csv.Sniffer().sniff(readahead, ",")
-            except csv.Error:
-                # Fallback to excel format
-                dialect = csv.excel
-
-            dialect_attrs = [
-                "delimiter",
-                "doublequote",
-                "escapechar",
-                "lineterminator",
-                "quotechar",
-                "quoting",
-                "skipinitialspace"
-            ]
-
-            self.detected_dialect = {x: getattr(dialect, x) for x in dialect_attrs}
-
-        if not getattr(self, "reader", None):
-            self.reader = csv.reader(handle, **self.detected_dialect)
+        if not getattr(self, "source_reader", None):
+            self.source_reader = self.get_source_reader_class()(
+                handle,
+                columns=getattr(self, "detected_columns", None),
+                dialect=getattr(self, "detected_dialect", None) or self.get_dialect(),
+                sample_size=self.get_meta().sniff_sample_size
+            )
+            self.detected_dialect = self.source_reader.dialect
 
         if not getattr(self, "detected_columns", None):
-            # On first iteration, the line will be the column headings,
+            # On first iteration, read the column headings,
             # store those and return False to skip processing
-            columns = self.reader.next()
-            self.detected_columns = columns
+            self.detected_columns = self.source_reader.read_header()
+            self._store_source_format()
             return False
 
-        cols = self.detected_columns
+        return self.source_reader.read_row()
 
-        try:
-            values = self.reader.next()
-        except StopIteration:
-            return None
+    def _store_source_format(self):
+        """
+        Save the detected columns and dialect, so that nothing has to sniff or read the header again
+        """
+        if not self.detected_columns_json:
+            self.detected_columns_json = json.dumps(self.detected_columns)
+            self.detected_dialect_json = json.dumps(self.detected_dialect)
+            self.__class__.objects.filter(pk=self.pk).update(
+                detected_columns_json=self.detected_columns_json,
+                detected_dialect_json=self.detected_dialect_json
+            )
+
+    def _create_shards(self, shards):
+        """
+        Save a batch of new shards and queue them for processing
+        """
+        with self.timings.phase(metrics.CREATE_SHARDS):
+            # The shards need the columns and dialect before they can start
+            self._store_source_format()
+
+            shard_model = self.get_shard_model()
+            ids = _allocate_ids(shard_model, len(shards))
+            if ids is not None:
+                for shard, pk in zip(shards, ids):
+                    shard.pk = pk
+
+            if ids is not None or _bulk_insert_returns_ids(shard_model):
+                shard_model.objects.bulk_create(shards)
+            else:
+                # The shards need their ids to be queued, and we can't find them out in advance
+                for shard in shards:
+                    shard.save()
 
-        if not values:
-            return None
+            self.defer_many([shard._queued_copy().process for shard in shards])
+
+    def _split_source(self, handle):
+        """
+        Create byte range shards of roughly Osmosis.bytes_per_shard each, by finding
+        the row boundaries near evenly spaced offsets rather than parsing every row.
+        Returns the number of shards created.
+        """
+        meta = self.get_meta()
 
-        return dict(zip(cols, values))
+        with self.timings.phase(metrics.PARSE):
+            self.next_source_row(handle)  # Read the header
+            size = handle.size
+
+            boundaries = [self.source_reader.position]
+            offset = boundaries[0] + meta.bytes_per_shard
+            while offset < size:
+                boundary = self.source_reader.find_row_boundary(offset)
+                if boundary is None:
+                    # Couldn't find one, so this shard just gets bigger
+                    offset += meta.bytes_per_shard
+                    continue
+
+                if boundaries[-1] < boundary < size:
+                    boundaries.append(boundary)
+                offset = max(offset, boundary) + meta.bytes_per_shard
+            boundaries.append(size)
+
+        shard_model = self.get_shard_model()
+        new_shards = [
+            shard_model(
+                task_id=self.pk,
+                task_model_path=self.model_path,
+                last_row_processed=0,
+                total_rows=None,  # Counted by the shard
+                start_line_number=1,  # Until finish() renumbers them from the start of the file
+                presplit=True,
+                source_byte_start=start,
+                source_byte_end=end
+            )
+            for start, end in zip(boundaries, boundaries[1:])
+            if start < end
+        ]
+
+        for i in xrange(0, len(new_shards), taskqueue.MAX_TASKS_PER_ADD):
+            self._create_shards(new_shards[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+        return len(new_shards)
 
     def process(self):
         # Reload, we've been pickled in'it
         self = self.__class__.objects.get(pk=self.pk)
-        self.status = ImportStatus.IN_PROGRESS
+        if self.status == ImportStatus.CANCELLED:
+            return  # Cancelled before it started
+        # If it's been paused, the shards will pause as they start
+        self._change_status(ImportStatus.IN_PROGRESS, (ImportStatus.PENDING,))
 
         meta = self.get_meta()
+        self.timings = metrics.Timings(started=time.time())
+        if self.retry_of_id is not None:
+            self._create_retry_shards()
+            return
+
+        datastore_calls = metrics.DatastoreCalls()
 
-        uploaded_file = self.source_data
+        uploaded_file = self.open_source_data()
+        reader_class = self.get_source_reader_class()
+        # Formats which can't be read from part way through fall back to storing the rows
+        byte_ranges = meta.shard_source == ShardSource.BYTE_RANGE and reader_class.byte_ranges
+        shard_model = self.get_shard_model()
+        new_shards = []
+        shard_count = 0
         shard_data = []
+        shard_rows = 0
+        shard_start = shard_end = None
         lineno = 0
 
-        while True:
+        rows_per_shard = meta.rows_per_shard
+        sample = None  # Rows to time, if we need to pick rows_per_shard
+        if meta.target_shard_seconds:
+            row_seconds = self._history_row_seconds()
+            if row_seconds is None:
+                sample = []
+            else:
+                rows_per_shard = self._rows_per_shard(row_seconds)
+
+        presplit = byte_ranges and meta.bytes_per_shard
+        if presplit:
+            shard_count = self._split_source(uploaded_file)
+
+        while not presplit:
             lineno += 1  # Line numbers are 1-based
-            data = self.next_source_row(uploaded_file)
+            with self.timings.phase(metrics.PARSE):
+                data = self.next_source_row(uploaded_file)
 
             if data is False:
-                # Skip this row
+                # Skip this row, the first one will be the header
+                if shard_start is None and byte_ranges:
+                    shard_start = self.source_reader.position
                 continue
             elif data:
-                shard_data.append(data)  # Keep a buffer of the data to process in this shard
+                if byte_ranges:
+                    shard_end = self.source_reader.position
+                else:
+                    shard_data.append(data)  # Keep a buffer of the data to process in this shard
+                shard_rows += 1
+                if sample is not None:
+                    sample.append(data)
+
+            if sample is not None and (len(sample) == meta.adaptive_sample_rows or data is None):
+                rows_per_shard = self._rows_per_shard(self._sample_row_seconds(sample))
+                sample = None
 
-            data_length = len(shard_data)
-            if shard_data and (data_length == meta.rows_per_shard or data is None):
+            data_length = shard_rows
+            if shard_rows and sample is None and (data_length >= rows_per_shard or data is None):
                 # If we hit the predefined shard count, or the EOF of the
                 # file then process what we have
 
-                new_shard = self.get_shard_model().objects.create(
+                if byte_ranges:
+                    source = dict(source_byte_start=shard_start, source_byte_end=shard_end)
+                else:
+                    source = dict(source_data_json=encode_rows(
+                        shard_data, self.detected_columns, compress=meta.compress_shards
+                    ))
+
+                new_shards.append(shard_model(
                     task_id=self.pk,
                     task_model_path=self.model_path,
-                    source_data_json=json.dumps(shard_data),
                     last_row_processed=0,
                     total_rows=data_length,
-                    start_line_number=lineno - data_length
-                )
+                    # Rows are numbered from 1 after the header. At the end of the file
+                    # lineno has already been moved on past the last row.
+                    start_line_number=lineno - data_length - (0 if data else 1),
+                    **source
+                ))
+                shard_count += 1
 
-                self.shard_count += 1
-                self.save()
+                if len(new_shards) == taskqueue.MAX_TASKS_PER_ADD:
+                    self._create_shards(new_shards)
+                    new_shards = []
 
-                self.defer(new_shard.process)
                 shard_data = []
+                shard_rows = 0
+                shard_start = shard_end
 
             if not data:
                 # Break at the end of the file
                 break
 
+        if new_shards:
+            self._create_shards(new_shards)
+
+        self.timings.count(metrics.DATASTORE_CALLS, datastore_calls.take())
         # 2 == HEADER + 1-based to 0-based
-        self.__class__.objects.filter(pk=self.pk).update(row_count=lineno - 2)
+        self._shards_created(shard_count, lineno - 2 if lineno else None)
+
+    def _shards_created(self, shard_count, row_count=None):
+        """
+        Record the number of shards (and rows) once they have all been created
+        """
+        # Shards which have already finished only count towards completion once
+        # shard_count is set, so set it (and trigger finish if needed) transactionally
+        @transactional
+        def update_task():
+            task = self.__class__.objects.get(pk=self.pk)
+            task.shard_count = shard_count
+            if row_count is not None:
+                task.row_count = row_count
+            task.metrics_json = metrics.Timings.from_json(task.metrics_json).merge(self.timings).to_json()
+            task.save()
+
+        update_task()
+        self.get_metrics().record(self, self.timings)
+
+        if shard_count:
+            # The shards may all have finished already
+            self._check_finished()
+        else:
+            # Nothing to wait for
+            self.defer(self._queued_copy().finish)
+
+    def _retry_rows(self, original):
+        """
+        Generator of (lineno, data) for the rows which failed in the `original` task, read from
+        its stored errors, or from the corrected error CSV which is this task's source data
+        """
+        columns = json.loads(original.detected_columns_json)
+        shards = original.get_shard_model().objects.filter(
+            task_id=original.pk, task_model_path=original.model_path
+        ).order_by("pk")  # The order their errors are written to the error CSV
+        # Errors stored by old versions of osmosis don't have a line number
+        errors = ((error.line_number or 0, error.line) for shard in shards for error in shard._get_errors())
+
+        if not self.source_data:
+            for lineno, line in errors:
+                values = json.loads(line)[:-1]  # Without the error message
+                yield lineno, OrderedDict(zip(columns, values))
+            return
+
+        line_numbers = [lineno for lineno, line in errors]
+        reader = self.get_source_reader_class()(
+            self.open_source_data(), dialect=self.get_dialect(), sample_size=self.get_meta().sniff_sample_size
+        )
+        reader.read_header()
+        rows = []
+        while True:
+            data = reader.read_row()
+            if data is None:
+                break
+            elif data is not False:
+                data.pop(ERRORS_COLUMN, None)
+                rows.append(data)
+
+        if len(rows) != len(line_numbers):
+            # Rows have been added or removed, so use the lines of the corrected file,
+            # numbered from 1 after the header like those of any other import
+            line_numbers = xrange(1, len(rows) + 1)
+        for lineno, data in itertools.izip(line_numbers, rows):
+            yield lineno, data
+
+    def _create_retry_shards(self):
+        """
+        process() for a task created by retry_errors: shard the rows which
+        failed in the original task, rather than parsing a source file
+        """
+        meta = self.get_meta()
+        datastore_calls = metrics.DatastoreCalls()
+        original = self.__class__.objects.get(pk=self.retry_of_id)
+        columns = json.loads(self.detected_columns_json)
+        shard_model = self.get_shard_model()
+
+        new_shards = []
+        shard_count = row_count = 0
+        rows = self.timings.timed(metrics.PARSE, self._retry_rows(original))
+        while True:
+            chunk = list(itertools.islice(rows, meta.rows_per_shard))
+            if not chunk:
+                break
+
+            line_numbers = [lineno for lineno, data in chunk]
+            new_shards.append(shard_model(
+                task_id=self.pk,
+                task_model_path=self.model_path,
+                last_row_processed=0,
+                total_rows=len(chunk),
+                start_line_number=line_numbers[0],
+                line_numbers_json=json.dumps(line_numbers),
+                source_data_json=encode_rows([data for lineno, data in chunk], columns, compress=meta.compress_shards)
+            ))
+            shard_count += 1
+            row_count += len(chunk)
+
+            if len(new_shards) == taskqueue.MAX_TASKS_PER_ADD:
+                self._create_shards(new_shards)
+                new_shards = []
+
+        if new_shards:
+            self._create_shards(new_shards)
+
+        self.timings.count(metrics.DATASTORE_CALLS, datastore_calls.take())
+        self._shards_created(shard_count, row_count)
+
+    def _counter_name(self, name):
+        return "%s:%s:%s" % (self.model_path, self.pk, name)
+
+    def _history_counter_name(self, name):
+        # Shared by every task of this class
+        return "%s:history:%s" % (self.model_path, name)
+
+    def _history_row_seconds(self):
+        """
+        The average time taken per row by previous imports of this task class,
+        or None if there isn't enough history to go on
+        """
+        ms_name = self._history_counter_name("ms")
+        rows_name = self._history_counter_name("rows")
+        totals = ShardedCounter.totals([ms_name, rows_name])
+        if totals[rows_name] < self.get_meta().adaptive_sample_rows:
+            return None
+        return totals[ms_name] / 1000.0 / totals[rows_name]
+
+    def _sample_row_seconds(self, sample):
+        """
+        The average time taken to validate the rows in `sample`. Importing them
+        will take longer, which is why shards are split if they run long.
+        """
+        if not sample:
+            return None
+
+        form_builders = self.get_form_builders()
+        start = time.time()
+        if self.get_meta().lookup_prefetch_rows:
+            for build_form in form_builders:
+                if isinstance(build_form, FormPrototype):
+                    build_form.prefetch(sample)
+        for data in sample:
+            for build_form in form_builders:
+                build_form(data).is_valid()
+        return (time.time() - start) / len(sample)
+
+    def _rows_per_shard(self, row_seconds):
+        meta = self.get_meta()
+        if row_seconds is None:
+            return meta.rows_per_shard
+
+        rows = int(meta.target_shard_seconds / max(row_seconds, 0.000001))
+        return max(1, min(rows, meta.max_rows_per_shard))
+
+    def progress(self):
+        """
+        Return a snapshot of the task's progress. The counts are kept in sharded
+        counters which are all read in a single batch.
+        """
+        task = self.__class__.objects.get(pk=self.pk)
+        names = {
+            self._counter_name(name): name
+            for name in (
+                "shards_processed", "shards_split", "continuations",
+                "rows_imported", "rows_errored", "rows_counted"
+            )
+        }
+        counts = {names[key]: total for key, total in ShardedCounter.totals(names.keys()).items()}
+
+        return {
+            "status": task.status,
+            "dry_run": task.dry_run,
+            "shard_count": task.shard_count + counts["shards_split"],
+            "shards_processed": counts["shards_processed"],
+            # Set by process, or counted by each shard if the file was pre-split
+            "row_count": task.row_count + counts["rows_counted"],
+            "rows_imported": counts["rows_imported"],
+            "rows_errored": counts["rows_errored"],
+            "continuations": counts["continuations"],
+        }
+
+    def _check_finished(self):
+        """
+        Defer finish if every shard has written its errors. This is called by each
+        shard when it's done, and by process once it knows how many shards there are.
+        Whichever of those sees the count reach the number of shards first defers
+        finish, and only that one.
+        """
+        shard_count = self.__class__.objects.get(pk=self.pk).shard_count
+        finalized_name = self._counter_name("shards_finalized")
+        split_name = self._counter_name("shards_split")
+        totals = ShardedCounter.totals([finalized_name, split_name])
+
+        # A shard is split in the same transaction which counts the new one, so
+        # this can't be satisfied while a split shard is still outstanding
+        if shard_count and totals[finalized_name] >= shard_count + totals[split_name]:
+            @transactional
+            def claim_finish():
+                if ShardedCounter.claim(self._counter_name("finish_deferred")):
+                    # On the datastore the task is only added if the claim is committed
+                    self.defer(self._queued_copy().finish, _transactional=_uses_datastore())
+
+            claim_finish()
+
+    def _queued_copy(self):
+        """
+        A copy of this task to defer finish (or another method which reloads the task) on.
+        This may be holding things which can't be pickled, like the source_reader of a shard.
+        """
+        return self.__class__(pk=self.pk)
 
     def instantiate_form(self, form_class, data):
         return form_class(data)
 
+    def get_form_builders(self):
+        """
+        Return a callable for each form in Osmosis.forms which takes a row of data
+        and returns the form bound to it.
+        """
+        meta = self.get_meta()
+        custom_instantiate = type(self).instantiate_form.__func__ is not AbstractImportTask.instantiate_form.__func__
+
+        builders = []
+        for form_class in meta.forms:
+            if meta.reuse_forms and not custom_instantiate and can_rebind(form_class):
+                builders.append(FormPrototype(form_class))
+            else:
+                builders.append(functools.partial(self.instantiate_form, form_class))
+        return builders
+
     def import_row(self, forms, cleaned_data):
         """
         Called when a row of source data is found to be valid and is ready for saving
         """
         raise NotImplementedError()
 
+    def import_rows(self, rows):
+        """
+        Called with a batch of valid rows when Osmosis.import_batch_size is set.
+        `rows` is a list of (row, forms, cleaned_data) tuples, where `row` is the index
+        of the row in its shard (line numbers aren't unique in a retried import).
+
+        Return a dict of {row: ValidationError} for any rows which failed to import
+        """
+        failed = {}
+        for row, forms, cleaned_data in rows:
+            try:
+                self.import_row(forms, cleaned_data)
+            except ValidationError, e:
+                failed[row] = e
+        return failed
+
     def _error_csv_filename(self):
-        meta = self.get_meta()
-        return '/%s/%s/%s.csv' % (
-            get_default_gcs_bucket_name(),
-            meta.error_csv_subdirectory,
-            self.pk
-        )
+        return self.get_storage().path(self.get_meta().error_csv_subdirectory, "%s.csv" % self.pk)
 
     def finish(self):
         """
@@ -295,70 +1051,90 @@ class AbstractImportTask(models.Model):
         # Refresh object
         self = self._meta.model.objects.get(pk=self.pk)
 
-        # If this was called before, don't do anything
-        if self.status == ImportStatus.FINISHED:
+        # If this was called before, or the import was cancelled, don't do anything
+        if self.status in (ImportStatus.FINISHED, ImportStatus.CANCELLED):
             return
 
+        started = time.time()
+        storage = self.get_storage()
+        shards = self.get_shard_model().objects.filter(
+            task_id=self.pk, task_model_path=self.model_path
+        ).order_by("pk")  # Relied on by retry_errors to match a corrected error CSV up with the errors
+        shard_values = list(shards.values_list("error_csv_filename", "metrics_json"))
+        self._rebase_line_numbers(shards)
+
+        error_files = []
         if self.get_meta().generate_error_csv:
             self.error_csv_filename = self._error_csv_filename()
+            error_files = [filename for filename, _ in shard_values if filename]
 
-            with cloudstorage.open(self.error_csv_filename, 'w') as f:
-                # Concat all error csvs from shards into 1 file
-                has_written = False
+            if error_files:
+                if self.detected_columns_json:
+                    columns = json.loads(self.detected_columns_json)
+                else:
+                    columns = decode_columns(shards[0].source_data_json)
 
-                shards = self.get_shard_model().objects.filter(task_id=self.pk, task_model_path=self.model_path)
+                header = StringIO.StringIO()
+                csv.writer(header, **(self.get_dialect() or {})).writerow(columns + [ERRORS_COLUMN])
 
-                # The shards haven't necessarily finished writing their error files when this is called,
-                # because that happens in a defer. So we redefer this until they're all done.
-                if [shard for shard in shards if not shard.error_csv_written]:
-                    self.defer(self.finish)
-                    return
-
-                for shard in shards:
-                    if not shard.error_csv_filename:
-                        continue
-
-                    # If this is the first row, write the column headers
-                    if not has_written:
-                        data = json.loads(shard.source_data_json)[0]
-                        cols = getattr(self, "detected_columns", data.keys()) + [ "errors" ]
-                        csvwriter = csv.writer(f)
-                        csvwriter.writerow(cols)
-                        has_written = True
-
-                    # Write the shard's error file into the master file
-                    f.write(cloudstorage.open(shard.error_csv_filename).read())
-                    cloudstorage.delete(shard.error_csv_filename)
-
-            if has_written:
-                # Create a blobstore key for the GCS file
-                blob_key = create_gs_key('/gs%s' % self.error_csv_filename)
-                self.error_csv = '%s/errors.csv' % blob_key
-            else:
-                cloudstorage.delete(self.error_csv_filename)
+                # Concat all error csvs from shards into 1 file
+                storage.compose(error_files, self.error_csv_filename, header.getvalue())
+                self.error_csv = storage.file_field_name(self.error_csv_filename)
+
+        progress = self.progress()
+        self.shards_processed = progress["shards_processed"]
+        self.row_count = progress["row_count"]
+
+        # Add up the timings of every part of the import
+        timings = metrics.Timings.from_json(self.metrics_json)
+        for _, shard_metrics in shard_values:
+            timings.merge(metrics.Timings.from_json(shard_metrics))
+        finished = time.time()
+        timings.add(metrics.FINISH, finished - started)
+        summary = timings.summary(finished)
+        self.metrics_json = json.dumps(summary)
 
         self.status = ImportStatus.FINISHED
         self.save()
 
-    def save(self, *args, **kwargs):
-        defer_finish = False
+        sink = self.get_metrics()
+        sink.record(self, metrics.Timings(seconds={metrics.FINISH: finished - started}))
+        sink.finished(self, summary)
 
-        if all([
-            self.status == ImportStatus.IN_PROGRESS,
-            self.shard_count,
-            self.shards_processed == self.shard_count,
-            not self.shards_error_csv_written,
-        ]):
-            # Defer the finish callback when we've processed all shards
-            defer_finish = True
+        # Only remove the shard files once the combined one is safely recorded
+        storage.delete(error_files)
 
-        result = super(AbstractImportTask, self).save(*args, **kwargs)
+    def _rebase_line_numbers(self, shards):
+        """
+        Shards created by _split_source number their rows from 1, because they can't know how
+        many rows come before them. Now that every shard has counted its rows, renumber them
+        (and their errors) from the start of the file. Safe to repeat if finish() is retried.
+        """
+        presplit = sorted(
+            (start, pk, total_rows, start_line_number)
+            for pk, start, total_rows, start_line_number, is_presplit in shards.values_list(
+                "pk", "source_byte_start", "total_rows", "start_line_number", "presplit"
+            )
+            if is_presplit
+        )
 
-        if defer_finish:
-            self.defer(self.finish)
-        return result
+        line_number = 1
+        for start, pk, total_rows, start_line_number in presplit:
+            if start_line_number != line_number:
+                for error in ImportShardError.objects.filter(shard_id=pk):
+                    if error.row is not None:
+                        error.line_number = line_number + error.row
+                        error.save()
+                self.get_shard_model().objects.filter(pk=pk).update(start_line_number=line_number)
+            line_number += total_rows or 0
 
     def handle_error(self, lineno, data, errors):
+        """
+        Called for each row which fails. For a shard created with Osmosis.bytes_per_shard,
+        `lineno` counts from the start of that shard (which is self.current_shard) as
+        the rows before it haven't been counted yet. The stored errors are renumbered
+        from the start of the file when the import finishes.
+        """
         pass
 
 
@@ -374,157 +1150,755 @@ class ModelImportTaskMixin(object):
     def import_row(self, forms, cleaned_data):
         return [form.save() for form in forms]
 
+    def _can_bulk_save(self, form):
+        if not isinstance(form, django_forms.BaseModelForm):
+            return False
+
+        model = form._meta.model
+        return all([
+            form.instance.pk is None,
+            not model._meta.many_to_many,
+            # Custom save() methods need to be called for each form
+            getattr(type(form).save, "__func__", None) is django_forms.BaseModelForm.save.__func__,
+            # bulk_create bypasses Model.save and its signals
+            model.save.__func__ is models.Model.save.__func__,
+            not signals.pre_save.has_listeners(model),
+            not signals.post_save.has_listeners(model),
+            # and can't save multi-table inheritance (proxies are fine)
+            all(parent._meta.concrete_model is model._meta.concrete_model for parent in model._meta.get_parent_list()),
+        ])
+
+    def import_rows(self, rows):
+        """
+        Save a batch of rows with a single bulk_create per model. Rows which can't
+        be saved in bulk (existing instances, m2m fields, custom save methods, signal
+        receivers, forms for more than one model) and every row of a model whose
+        bulk_create fails, are saved one at a time so that errors are reported
+        against the correct line.
+        """
+        if getattr(type(self).import_row, "__func__", None) is not ModelImportTaskMixin.import_row.__func__:
+            # import_row has been overridden, so we can't bypass it
+            return super(ModelImportTaskMixin, self).import_rows(rows)
+
+        # Only rows whose forms are all for the same model are saved in bulk, so that a
+        # failed bulk_create can be retried without saving any row's instances twice
+        rows_by_model = OrderedDict()
+        single_rows = []
+        for row in rows:
+            row_models = set(form._meta.model for form in row[1] if isinstance(form, django_forms.BaseModelForm))
+            if len(row_models) == 1 and all([self._can_bulk_save(form) for form in row[1]]):
+                rows_by_model.setdefault(row_models.pop(), []).append(row)
+            else:
+                single_rows.append(row)
+
+        for model, model_rows in rows_by_model.items():
+            model_instances = [form.save(commit=False) for row, forms, cleaned_data in model_rows for form in forms]
+            try:
+                model.objects.bulk_create(model_instances)
+            except (ValidationError, IntegrityError):
+                # Retry this model's rows one by one to find out which lines are the problem
+                single_rows.extend(model_rows)
+
+        return super(ModelImportTaskMixin, self).import_rows(single_rows)
+
 
 class ImportShard(models.Model):
     task_model_path = models.CharField(max_length=500, editable=False)
     task_id = models.PositiveIntegerField()
 
     source_data_json = models.TextField()
+    # Used instead of source_data_json for ShardSource.BYTE_RANGE shards
+    source_byte_start = models.PositiveIntegerField(null=True)
+    source_byte_end = models.PositiveIntegerField(null=True)
     last_row_processed = models.PositiveIntegerField(default=0)
-    total_rows = models.PositiveIntegerField(default=0)
+    # None until a shard created by AbstractImportTask._split_source has read its rows
+    total_rows = models.PositiveIntegerField(default=0, null=True)
     start_line_number = models.PositiveIntegerField(default=0)
     complete = models.BooleanField(default=False)
+    # How many times processing was handed on to a new task to avoid the request deadline
+    continuations = models.PositiveIntegerField(default=0)
+    # Stopped at a checkpoint because the task was paused, see AbstractImportTask.resume
+    paused = models.BooleanField(default=False)
+    # The line number of each row, for shards whose rows aren't consecutive lines (see retry_errors)
+    line_numbers_json = models.TextField(default="", editable=False)
+    # Created by AbstractImportTask._split_source, or split from one that was. Its line numbers
+    # count from the start of its part of the file, until AbstractImportTask.finish rebases them.
+    presplit = models.BooleanField(default=False)
     error_csv_filename = models.CharField(max_length=1023)
     error_csv_written = models.BooleanField(default=False)
+    # See osmosis.metrics
+    metrics_json = models.TextField(default="", editable=False)
 
     def __init__(self, *args, **kwargs):
         self.errors = []
+        self._task_cache = None
+        self.task_fetches = 0  # How many times the task has been loaded from the database
+        self.rows_errored = 0  # Since the last checkpoint
+        self.timings = metrics.Timings()  # Since the last checkpoint
+        self.queued_at = None  # When this was deferred, see _queued_copy
+        self._line_numbers = None
         super(ImportShard, self).__init__(*args, **kwargs)
 
+    def __setstate__(self, state):
+        # A task cached before we were pickled will be out of date
+        state = dict(
+            state, _task_cache=None, task_fetches=0, rows_errored=0, timings=metrics.Timings(), _line_numbers=None
+        )
+        parent = getattr(super(ImportShard, self), "__setstate__", None)
+        if parent:
+            parent(state)
+        else:
+            self.__dict__.update(state)
+
+    @property
+    def task_model(self):
+        return apps.get_model(*self.task_model_path.split("."))
+
+    @property
+    def meta(self):
+        return self.task_model.get_meta()
+
     @property
     def task(self):
-        model = apps.get_model(*self.task_model_path.split("."))
-        return model.objects.get(pk=self.task_id)
+        """
+        The task this shard belongs to. It's loaded once and cached until
+        the shard is pointed at a different task, or refresh_task() is called.
+        """
+        key = (self.task_model_path, self.task_id)
+        if self._task_cache is None or self._task_cache[0] != key:
+            self._task_cache = (key, self.task_model.objects.get(pk=self.task_id))
+            self.task_fetches += 1
+        return self._task_cache[1]
 
-    def process(self):
-        meta = self.task.get_meta()
-        task_model = apps.get_model(*self.task.model_path.split("."))
+    def refresh_task(self):
+        self._task_cache = None
 
-        this = ImportShard.objects.get(pk=self.pk)  # Reload, self is pickled
-        source_data = json.loads(this.source_data_json)
+    def _queued_copy(self):
+        """
+        A copy of this shard to defer the processing of. Only the keys are
+        needed, so the task payload is kept small. It records when it was
+        queued, to measure how long it waits.
+        """
+        shard = self.__class__(pk=self.pk, task_id=self.task_id, task_model_path=self.task_model_path)
+        shard.queued_at = time.time()
+        return shard
+
+    def _add_timings(self, timings):
+        """
+        Add to the timings stored on the shard, before it's saved
+        """
+        self.metrics_json = metrics.Timings.from_json(self.metrics_json).merge(timings).to_json()
+
+    def _line_number(self, row):
+        """
+        The line number of the row at index `row`
+        """
+        if not self.line_numbers_json:
+            return self.start_line_number + row
+        if self._line_numbers is None:
+            self._line_numbers = json.loads(self.line_numbers_json)
+        return self._line_numbers[row]
+
+    def _source_rows(self, task, start=0):
+        """
+        Generator of (data, end) for the rows of this shard from index `start`, where `data` is
+        the source data dict and `end` is the byte offset just after the row (None if the rows
+        are stored on the shard)
+        """
+        if self.source_byte_end is None:
+            for data in decode_rows(self.source_data_json, start):
+                yield data, None
+            return
+
+        # Parse just our part of the file, using the columns and dialect from the start of it
+        task.detected_columns = json.loads(task.detected_columns_json)
+        task.detected_dialect = task.get_dialect()
+        task.source_reader = None
+
+        handle = task.open_source_data(self.source_byte_start, self.source_byte_end)
+
+        row = 0
+        while task.source_reader is None or task.source_reader.position < self.source_byte_end:
+            data = task.next_source_row(handle)
+            if data is None:
+                break
+            elif data is False:
+                continue
 
-        # If there are no rows to process
-        mark_shard_complete = this.last_row_processed == this.total_rows - 1 or this.total_rows == 0
+            if row >= start:
+                yield data, task.source_reader.position
+            row += 1
 
-        for i in xrange(this.last_row_processed, this.total_rows):  # Always continue from the last processed row
-            data = source_data[i]
+    def _prefetched(self, source_data, batch_size, prefetch):
+        """
+        Read ahead `batch_size` rows at a time, calling `prefetch` with each batch
+        so that what they refer to can be looked up together before they are validated
+        """
+        while True:
+            batch = list(itertools.islice(source_data, batch_size))
+            if not batch:
+                return
 
-            forms = [self.task.instantiate_form(form, data) for form in meta.forms]
+            with self.timings.phase(metrics.PREFETCH):
+                prefetch(batch)
+            for data in batch:
+                yield data
 
-            if all([form.is_valid() for form in forms]):
+    def process(self):
+        task = self.task
+        meta = self.meta
+
+        this = ImportShard.objects.get(pk=self.pk)  # Reload, self is pickled
+        if task.status in (ImportStatus.PAUSED, ImportStatus.CANCELLED) and this._stop(task):
+            return
+
+        dry_run = task.dry_run
+        count_rows = this.total_rows is None
+        processed_rows = this.last_row_processed
+        source_data = this._source_rows(task, this.last_row_processed)
+        if this.total_rows is not None:
+            source_data = itertools.islice(source_data, this.total_rows - this.last_row_processed)
+
+        form_builders = task.get_form_builders()
+        self.rows_errored = 0
+        started = time.time()
+        last_checkpoint = {"row": this.last_row_processed, "time": started}
+        history = {"ms": 0, "rows": 0, "time": started}  # Not yet added to the history counters
+        status_checked = {"time": started}
+
+        def stop_requested():
+            # Only checked every so often, even then it's usually just a memcache get
+            if time.time() - status_checked["time"] < meta.status_check_seconds:
+                return False
+            status_checked["time"] = time.time()
+            return task.current_status() in (ImportStatus.PAUSED, ImportStatus.CANCELLED)
+
+        datastore_calls = metrics.DatastoreCalls()
+        self.timings.count(metrics.SHARD_TASKS)
+        if getattr(self, "queued_at", None) is not None:
+            self.timings.add(metrics.QUEUE, started - self.queued_at)
+        source_data = self.timings.timed(metrics.PARSE, source_data)
+
+        prototypes = [builder for builder in form_builders if isinstance(builder, FormPrototype) and builder.lookups]
+        if not meta.lookup_prefetch_rows:
+            prototypes = []
+
+        unique = task.get_unique_key()
+        detector = DuplicateDetector(task, this) if unique and meta.detect_duplicates else None
+        # Rows are identified by their index in the shard, the line numbers of a retry can repeat
+        row_keys = {}  # {row: unique key} of the rows which have been read ahead
+        existing = {}  # {unique key: instance} of those which are already in the database
+        duplicates = {}  # {row: the line it duplicates}
+        read_ahead = {"row": this.last_row_processed}
+
+        def prefetch(batch):
+            batch = [data for data, end in batch]
+            for prototype in prototypes:
+                prototype.prefetch(batch)
+
+            if unique:
+                first_row = read_ahead["row"]
+                read_ahead["row"] += len(batch)
+                keys = [(unique.key(data), row, this._line_number(row)) for row, data in enumerate(batch, first_row)]
+                keys = [(key, row, lineno) for key, row, lineno in keys if key is not None]
+                row_keys.update((row, key) for key, row, lineno in keys)
+
+                if unique.model and keys:
+                    existing.update(unique.existing(key for key, row, lineno in keys))
+                if detector:
+                    duplicates.update(detector.check(keys))
+
+        if prototypes or unique:
+            source_data = self._prefetched(source_data, meta.lookup_prefetch_rows or 1, prefetch)
+
+        def checkpoint(row, total_rows=None):
+            now = time.time()
+            rows = row - this.last_row_processed
+            counts = {
+                task._counter_name("rows_imported"): rows - self.rows_errored,
+                task._counter_name("rows_errored"): self.rows_errored,
+            }
+            if meta.target_shard_seconds and not dry_run:
+                # Used to size the shards of future imports, which dry runs would make look quick.
+                # Only sampled, so that the history counters aren't written by every checkpoint.
+                history["ms"] += int((now - last_checkpoint["time"]) * 1000)
+                history["rows"] += rows
+                last_row = total_rows is not None or row == this.total_rows
+                if history["rows"] and (last_row or now - history["time"] >= HISTORY_SAMPLE_SECONDS):
+                    counts[task._history_counter_name("ms")] = history["ms"]
+                    counts[task._history_counter_name("rows")] = history["rows"]
+                    history.update(ms=0, rows=0, time=now)
+            self.rows_errored = 0
+            last_checkpoint.update(row=row, time=now)
+
+            self.timings.count(metrics.ROWS, rows)
+            self.timings.count(metrics.DATASTORE_CALLS, datastore_calls.take())
+            timings = self.timings.take()
+            result = this._checkpoint(row, total_rows=total_rows, counts=counts, timings=timings)
+            # Stored with the next checkpoint
+            self.timings.add(metrics.CHECKPOINT, time.time() - now)
+            task.get_metrics().record(task, timings, shard=this)
+            return result
+
+        pending_rows = []  # Valid (row, forms, cleaned_data) waiting for import_rows() when batching
+        pending_source_rows = {}  # {row: source data}
+
+        def import_pending_rows():
+            if not pending_rows:
+                return
+
+            with self.timings.phase(metrics.IMPORT):
+                failed = task.import_rows(pending_rows)
+            for row, forms, cleaned_data in pending_rows:
+                if row in failed:
+                    self.handle_error(
+                        this._line_number(row), cleaned_data, _validation_error_messages(failed[row]),
+                        source_row=pending_source_rows[row], row=row
+                    )
+            del pending_rows[:]
+            pending_source_rows.clear()
+
+        for i, (data, end) in enumerate(source_data, this.last_row_processed):  # Always continue from the last processed row
+            lineno = this._line_number(i)
+            processed_rows = i + 1
+
+            duplicate_of = duplicates.pop(i, None)
+            read_error = data.get(READ_ERROR_KEY)
+            with self.timings.phase(metrics.VALIDATE):
+                forms = [build_form(data) for build_form in form_builders]
+                instance = existing.get(row_keys.pop(i, None))
+                if instance is not None:
+                    unique.attach(forms, instance)
+                valid = read_error is None and duplicate_of is None and all([form.is_valid() for form in forms])
+
+            if valid and dry_run:
+                pass  # Only validating
+            elif valid:
                 # All forms are valid, let's process this shizzle
 
                 cleaned_data = {}
                 for form in forms:
                     cleaned_data.update(form.cleaned_data)
 
-                try:
-                    self.task.import_row(forms, cleaned_data)
-                except ValidationError, e:
-                    # We allow subclasses to raise a validation error on import_row
-                    errors = []
-                    if hasattr(e, 'message_dict'):
-                        for name, errs in e.message_dict.items():
-                            for err in errs:
-                                errors.append("{0}: {1}".format(name, err))
-                    else:
-                        # Pre 1.6, ValidationError does not necessarily have a message_dict
-                        for err in e.messages:
-                            errors.append(err)
-
-                    self.handle_error(this.start_line_number + i, cleaned_data, errors)
+                if meta.import_batch_size:
+                    pending_rows.append((i, forms, cleaned_data))
+                    pending_source_rows[i] = data
+                    if len(pending_rows) >= meta.import_batch_size:
+                        import_pending_rows()
+                else:
+                    try:
+                        with self.timings.phase(metrics.IMPORT):
+                            task.import_row(forms, cleaned_data)
+                    except ValidationError, e:
+                        # We allow subclasses to raise a validation error on import_row
+                        self.handle_error(
+                            lineno, cleaned_data, _validation_error_messages(e), source_row=data, row=i
+                        )
             else:
                 # We've encountered an error, call the error handler
                 errors = []
+                if read_error is not None:
+                    # The source couldn't be read, so the forms have nothing to say
+                    errors.append(read_error)
+                    forms = []
+                if duplicate_of is not None:
+                    errors.append(DUPLICATE_ERROR)
                 for form in forms:
                     for name, errs in form.errors.items():
                         for err in errs:
                             errors.append("{0}: {1}".format(name, err))
 
-                self.handle_error(this.start_line_number + i, data, errors)
+                self.handle_error(lineno, data, errors, row=i)
 
-            # Now update the last processed row, transactionally
-            @transactional
-            def update_shard(_this):
-                _this = ImportShard.objects.get(pk=_this.pk)
-                _this.last_row_processed += 1
-                _this.save()
-                return _this
+            elapsed = time.time() - started
+            split = meta.target_shard_seconds and elapsed > meta.target_shard_seconds * meta.shard_split_factor
+            out_of_time = meta.shard_deadline_seconds is not None and elapsed > meta.shard_deadline_seconds
+
+            # Checked whether or not a checkpoint is due, as dry runs rarely write one
+            stopping = stop_requested()
 
-            this = update_shard(this)
-            # If this was the last iteration then mark as complete
-            mark_shard_complete = i == this.total_rows - 1
+            # Periodically record how far we've got, so that a retry can resume from here.
+            # Dry runs are cheap to repeat, so they only checkpoint to split, continue or stop.
+            if split or out_of_time or stopping or not dry_run and (
+                i + 1 - last_checkpoint["row"] >= meta.checkpoint_rows or
+                (meta.checkpoint_seconds and time.time() - last_checkpoint["time"] >= meta.checkpoint_seconds)
+            ):
+                # Rows before a checkpoint must have been imported, and their errors stored
+                import_pending_rows()
+                self._flush_errors()
+                this = checkpoint(i + 1)
+
+                if stopping and this._stop(task):
+                    return
+
+            if split:
+                # We're taking too long, hand the rest of our rows to a new shard
+                if detector:
+                    # Including those we've read ahead
+                    detector.release(i + 1)
+                this = this._split(task, i + 1, end)
+                break
+            elif out_of_time and (this.total_rows is None or i + 1 < this.total_rows):
+                # Carry on from the checkpoint in a new task, before this one is killed
+                this._continue(task)
+                return
+
+        import_pending_rows()
+        self._flush_errors()
+
+        if count_rows:
+            # We've read to the end of our byte range, so now we know how many rows there are
+            this = checkpoint(processed_rows, total_rows=processed_rows)
+        elif this.last_row_processed < this.total_rows:
+            this = checkpoint(this.total_rows)
+
+        # If all the rows have been processed (or there were none) then mark as complete
+        if this.last_row_processed >= this.total_rows:
+            timings = self.timings.take()
 
-        if mark_shard_complete:
             @transactional
-            def update_task(_this):
+            def mark_complete(_this):
                 if _this.complete:
                     return
 
-                task = task_model.objects.get(pk=_this.task_id)
-                task.shards_processed += 1
-                task.save()
-
                 _this.complete = True
+                _this._add_timings(timings)
                 _this.save()
 
-            update_task(this)
-            deferred.defer(this._finalize_errors, _queue=self.task.get_meta().queue)
+                # Progress is kept in sharded counters, so we don't contend with the other shards on the task
+                ShardedCounter.increment(task._counter_name("shards_processed"))
+                if count_rows:
+                    ShardedCounter.increment(task._counter_name("rows_counted"), _this.total_rows)
 
-    def handle_error(self, lineno, data, errors):
+            mark_complete(this)
+            task.get_metrics().record(task, timings, shard=this)
+            task.defer(this._queued_copy()._finalize_errors)
+
+    def _split(self, task, row, position=None):
+        """
+        Move the rows from index `row` onwards into a new shard, and queue it. For a byte
+        range shard `position` is the offset that row starts at. Returns the reloaded shard.
+        """
+        if self.source_byte_end is None:
+            source = dict(source_data_json=encode_rows(
+                list(decode_rows(self.source_data_json, row)),
+                decode_columns(self.source_data_json),
+                compress=self.meta.compress_shards
+            ))
+            source["total_rows"] = self.total_rows - row
+            truncate = dict(total_rows=row)
+            if self.line_numbers_json:
+                line_numbers = json.loads(self.line_numbers_json)
+                source["line_numbers_json"] = json.dumps(line_numbers[row:])
+                truncate["line_numbers_json"] = json.dumps(line_numbers[:row])
+        else:
+            # Not the reader's position, which may be rows ahead of `row`
+            source = dict(
+                source_byte_start=position,
+                source_byte_end=self.source_byte_end,
+                total_rows=None if self.total_rows is None else self.total_rows - row
+            )
+            truncate = dict(source_byte_end=position, total_rows=row)
+
+        if source["total_rows"] == 0 or source.get("source_byte_start") == self.source_byte_end:
+            return self  # Nothing left to split off
+
+        new_shard = self.__class__(
+            task_id=self.task_id,
+            task_model_path=self.task_model_path,
+            start_line_number=self.start_line_number + row,
+            presplit=self.presplit,
+            **source
+        )
+
+        @transactional
+        def split(_this):
+            _this = ImportShard.objects.get(pk=_this.pk)
+            if _this.total_rows is not None and _this.total_rows <= row:
+                return _this  # Already split by an earlier attempt
+
+            for attr, value in truncate.items():
+                setattr(_this, attr, value)
+            _this.save()
+
+            new_shard.save()
+            ShardedCounter.increment(task._counter_name("shards_split"))
+            # On the datastore the task is only added if the split is committed
+            task.defer(new_shard._queued_copy().process, _transactional=_uses_datastore())
+            return _this
+
+        return split(self)
+
+    def _continue(self, task):
+        """
+        Queue another run of this shard, which will pick up from the last checkpoint
+        """
+        @transactional
+        def continue_shard(_this):
+            _this = ImportShard.objects.get(pk=_this.pk)
+            _this.continuations += 1
+            _this.save()
+
+            ShardedCounter.increment(task._counter_name("continuations"))
+            # On the datastore the task is only added if this is committed
+            task.defer(self._queued_copy().process, _transactional=_uses_datastore())
+
+        continue_shard(self)
+
+    def _stop(self, task):
+        """
+        Called when the task seems to have been paused or cancelled. The task's status is
+        checked again in the same transaction as the shard is marked as paused, so that it
+        can't be resumed without us. Returns True if the shard should stop.
+        """
+        @transactional
+        def stop(_this):
+            status = task.__class__.objects.get(pk=task.pk).status
+            if status == ImportStatus.PAUSED:
+                _this = ImportShard.objects.get(pk=_this.pk)
+                if not _this.paused:
+                    _this.paused = True
+                    _this.save()
+                    # Counted so that resume() can tell if its query for paused shards missed any
+                    ShardedCounter.increment(task._counter_name("shards_paused"))
+            return status in (ImportStatus.PAUSED, ImportStatus.CANCELLED)
+
+        return stop(self)
+
+    def _unpause(self, task):
+        """
+        Mark a paused shard as no longer paused, so that it can be queued to carry on from its
+        last checkpoint. Returns False if it had already been resumed.
+        """
+        @transactional
+        def unpause(_this):
+            _this = ImportShard.objects.get(pk=_this.pk)
+            if not _this.paused:
+                return False  # Already resumed
+
+            _this.paused = False
+            _this.save()
+            ShardedCounter.increment(task._counter_name("shards_paused"), -1)
+            return True
+
+        return unpause(self)
+
+    def _checkpoint(self, last_row_processed, total_rows=None, counts=None, timings=None):
+        """
+        Transactionally record that every row before `last_row_processed` has been
+        handled, and optionally the number of rows in the shard. `counts` is a dict
+        of {counter name: amount} to add for the rows since our last checkpoint,
+        and `timings` the osmosis.metrics.Timings since then.
+        Returns the reloaded shard.
+        """
+        expected = self.last_row_processed
+
+        @transactional
+        def update_shard(_this):
+            _this = ImportShard.objects.get(pk=_this.pk)
+            previous = _this.last_row_processed
+            # Never move backwards, a retried task may be behind a checkpoint which was already written
+            _this.last_row_processed = max(previous, last_row_processed)
+            if total_rows is not None:
+                _this.total_rows = total_rows
+            if timings:
+                _this._add_timings(timings)
+            _this.save()
+
+            # Only count the rows if nobody else has checkpointed them already
+            if previous == expected and last_row_processed > previous:
+                for name, amount in (counts or {}).items():
+                    if amount:
+                        ShardedCounter.increment(name, amount)
+            return _this
+
+        return update_shard(self)
+
+    def handle_error(self, lineno, data, errors, source_row=None, row=None):
+        """
+        `data` is passed on to the task's handle_error, the error CSV gets
+        `source_row` (the row as it was read) if it's given. `row` is the
+        index of the row in the shard.
+        """
+        self.rows_errored += 1
+        self.task.current_shard = self
         self.task.handle_error(lineno, data, errors)
-        self._write_error_row(data, errors)
+        self._write_error_row(lineno, data if source_row is None else source_row, errors, row)
 
-    def _write_error_row(self, data, errors):
-        if not apps.get_model(*self.task.model_path.split(".")).get_meta().generate_error_csv:
+    def _write_error_row(self, lineno, data, errors, row=None):
+        """
+        Buffer an error row, it's saved by the next call to _flush_errors
+        """
+        if not self.meta.generate_error_csv:
             return
 
-        ImportShardError.objects.create(
-            shard=self,
-            line=json.dumps(data.values() + [". ".join(errors)])
-        )
+        if self.task.detected_columns_json:
+            if getattr(self, "_error_columns", None) is None:
+                self._error_columns = json.loads(self.task.detected_columns_json)
+            values = [data.get(column, "") for column in self._error_columns]
+        else:
+            values = data.values()
+
+        self.errors.append(ImportShardError(
+            shard_id=self.pk,
+            row=row,
+            line_number=lineno,
+            line=json.dumps(values + [". ".join(errors)])
+        ))
+
+    def _flush_errors(self):
+        """
+        Save the buffered error rows in one batch. This happens before each
+        checkpoint, so if the task is retried the rows since the last one may be
+        written twice; _get_errors ignores the duplicates.
+        """
+        if self.errors:
+            with self.timings.phase(metrics.WRITE_ERRORS):
+                ImportShardError.objects.bulk_create(self.errors)
+            self.errors = []
 
     def _error_csv_filename(self):
-        meta = self.task.get_meta()
-        return "/%s/%s/%s-shard-%s.csv" % (
-            get_default_gcs_bucket_name(),
-            meta.error_csv_subdirectory,
-            self.task.pk,
-            self.pk
+        return self.task_model.get_storage().path(
+            self.meta.error_csv_subdirectory, "%s-shard-%s.csv" % (self.task_id, self.pk)
         )
 
     def _get_errors(self):
-        return self.importsharderror_set.all()
+        """
+        The error rows of this shard, in line order, without any duplicates from retries
+        """
+        errors = {}
+        legacy_errors = []
+        for error in self.importsharderror_set.all():
+            # Line numbers aren't unique within the shards of a retried import, so
+            # errors are matched up by row, or by line if they were stored without one
+            if error.row is not None:
+                errors[(1, error.row)] = error
+            elif error.line_number is not None:
+                errors[(0, error.line_number)] = error
+            else:
+                legacy_errors.append(error)
+        return legacy_errors + [errors[key] for key in sorted(errors)]
 
     def _finalize_errors(self):
         self = self.__class__.objects.get(pk=self.pk)
-        task_model = apps.get_model(*self.task.model_path.split("."))
-        task = task_model.objects.get(pk=self.task_id)
+        task = self.task
+
+        if not self.error_csv_written:
+            error_csv_filename = ""
+            timings = metrics.Timings()
+            if self.meta.generate_error_csv:
+                with timings.phase(metrics.WRITE_ERRORS):
+                    errors = self._get_errors()
+                    if errors:
+                        error_csv_filename = self._error_csv_filename()
+                        with self.task_model.get_storage().writer(error_csv_filename) as f:
+                            writer = csv.writer(f, **(task.get_dialect() or {}))
+                            for error in errors:
+                                writer.writerow(json.loads(error.line))
 
-        if not task_model.get_meta().generate_error_csv:
-            self.error_csv_written = True
-            task.shards_error_csv_written = True
-            self.save()
-            task.save()
-            return
+            @transactional
+            def mark_written(_this):
+                _this = ImportShard.objects.get(pk=_this.pk)
+                if _this.error_csv_written:
+                    return
 
-        errors = self._get_errors()
-        if errors:
-            self.error_csv_filename = self._error_csv_filename()
+                _this.error_csv_filename = error_csv_filename
+                _this.error_csv_written = True
+                _this._add_timings(timings)
+                _this.save()
+                # Count down towards the task finishing
+                ShardedCounter.increment(task._counter_name("shards_finalized"))
 
-            def _write(_this):
-                with cloudstorage.open(self.error_csv_filename, "w") as f:
-                    writer = csv.writer(f)
-                    for error in errors:
-                        writer.writerow(json.loads(error.line))
-            _write(self)
+            mark_written(self)
+            task.get_metrics().record(task, timings, shard=self)
 
-        self.error_csv_written = True
-        task.shards_error_csv_written = True
-        self.save()
-        task.save()
+        # Checked even if we'd already finished, in case we failed before getting here last time
+        task._check_finished()
 
 
 class ImportShardError(models.Model):
     shard = models.ForeignKey(ImportShard)
+    # The index of the row in its shard
+    row = models.PositiveIntegerField(null=True)
+    line_number = models.PositiveIntegerField(null=True)
     line = models.TextField()
+
+
+class ShardedCounter(models.Model):
+    """
+    A named counter, split across NUM_SHARDS entities so that lots of
+    tasks can update it at once without contending on a single one.
+    """
+    NUM_SHARDS = 20
+
+    id = models.CharField(max_length=500, primary_key=True)
+    count = models.BigIntegerField(default=0)
+
+    @classmethod
+    def _keys(cls, name):
+        return ["%s:%s" % (name, i) for i in xrange(cls.NUM_SHARDS)]
+
+    @classmethod
+    def increment(cls, name, amount=1):
+        """
+        Add `amount` to a random shard of the counter. Call this inside a
+        transaction to tie the increment to some other write.
+        """
+        key = random.choice(cls._keys(name))
+        if _uses_datastore():
+            # A get and put in a transaction can't lose a concurrent update
+            @transactional
+            def increment_shard():
+                try:
+                    counter = cls.objects.get(pk=key)
+                except cls.DoesNotExist:
+                    counter = cls(pk=key)
+                counter.count += amount
+                counter.save()
+
+            increment_shard()
+            return
+
+        # Otherwise add to it in the database, rather than reading it and saving the result
+        if cls.objects.filter(pk=key).update(count=models.F("count") + amount):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(pk=key, count=amount)
+        except IntegrityError:
+            # Created by someone else since we looked
+            cls.objects.filter(pk=key).update(count=models.F("count") + amount)
+
+    @classmethod
+    def totals(cls, names):
+        """
+        Return a dict of {name: total} for the given counters, read in one batch
+        """
+        keys = {}
+        for name in names:
+            for key in cls._keys(name):
+                keys[key] = name
+
+        totals = dict.fromkeys(names, 0)
+        for counter in cls.objects.filter(pk__in=keys.keys()):
+            totals[keys[counter.pk]] += counter.count
+        return totals
+
+    @classmethod
+    def clear(cls, names):
+        """
+        Delete the given counters, and any claim() of the same names, in one batch
+        """
+        keys = list(names)
+        for name in names:
+            keys.extend(cls._keys(name))
+        cls.objects.filter(pk__in=keys).delete()
+
+    @classmethod
+    def claim(cls, name):
+        """
+        Return True the first time this is called for `name`, and False after
+        that. Call it inside a transaction.
+        """
+        counter, created = cls.objects.get_or_create(pk=name, defaults={"count": 1})
+        return created
@@ -0,0 +1,115 @@
+"""
+Encoding of the rows stored in ImportShard.source_data_json.
+
+Version 1 (written by older versions of osmosis) is a JSON list of row
+dicts. Version 2 stores the column names once, followed by one JSON array
+of values per line, so that rows can be decoded one at a time:
+
+    osmosis-shard:2[:zlib]
+    ["column1", "column2"]
+    ["value1", "value2"]
+    ...
+
+With zlib compression everything after the first line is compressed and
+base64 encoded, as the payload has to fit in a text field.
+"""
+
+import base64
+import json
+import StringIO
+import zlib
+
+VERSION_PREFIX = "osmosis-shard:2"
+ZLIB_SUFFIX = ":zlib"
+
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+
+def encode_rows(rows, columns=(), compress=False):
+    """
+    Encode a list of row dicts. `columns` gives the order of the
+    columns, any others found in the rows are added after them.
+    """
+    columns = list(columns)
+    known = set(columns)
+    for row in rows:
+        for column in row:
+            if column not in known:
+                columns.append(column)
+                known.add(column)
+
+    lines = [json.dumps(columns)]
+    for row in rows:
+        values = [row[column] for column in columns[:len(row)] if column in row]
+        if len(values) == len(row):
+            lines.append(json.dumps(values))
+        else:
+            # Keys missing from the middle of the row can't be represented positionally
+            lines.append(json.dumps(row))
+
+    body = "\n".join(lines)
+    if compress:
+        return VERSION_PREFIX + ZLIB_SUFFIX + "\n" + base64.b64encode(zlib.compress(body))
+    return VERSION_PREFIX + "\n" + body
+
+
+def _compressed_lines(body):
+    data = base64.b64decode(body)
+    decompressor = zlib.decompressobj()
+    remainder = ""
+    for i in xrange(0, len(data), DECOMPRESS_CHUNK_SIZE):
+        lines = (remainder + decompressor.decompress(data[i:i + DECOMPRESS_CHUNK_SIZE])).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+
+    remainder += decompressor.flush()
+    if remainder:
+        yield remainder
+
+
+def _decode(payload):
+    """
+    Return the columns and an iterator of the (still encoded) row lines
+    """
+    header, _, body = payload.partition("\n")
+    if header.endswith(ZLIB_SUFFIX):
+        lines = _compressed_lines(body)
+    else:
+        lines = (line.rstrip("\n") for line in StringIO.StringIO(body))
+
+    columns = json.loads(next(lines, "[]"))
+    return columns, lines
+
+
+def decode_columns(payload):
+    """
+    Return the column names of an encoded payload
+    """
+    if not payload.startswith(VERSION_PREFIX):
+        rows = json.loads(payload)
+        return rows[0].keys() if rows else []
+    return _decode(payload)[0]
+
+
+def decode_rows(payload, start=0):
+    """
+    Generator of the row dicts in an encoded payload, beginning at
+    index `start`. Rows are only parsed as they are needed.
+    """
+    if not payload.startswith(VERSION_PREFIX):
+        # Version 1
+        for row in json.loads(payload)[start:]:
+            yield row
+        return
+
+    columns, lines = _decode(payload)
+    for i, line in enumerate(lines):
+        if i < start:
+            continue
+
+        values = json.loads(line)
+        if isinstance(values, dict):
+            yield values
+        else:
+            yield dict(zip(columns, values))
@@ -0,0 +1,416 @@
+"""
+Readers which turn a source file into row dicts, one row at a time.
+
+The reader is chosen by the extension of the uploaded file, or with
+Osmosis.source_reader. Readers with `byte_ranges` can start reading from
+any row boundary, so their files can be split into ShardSource.BYTE_RANGE
+shards; the others are parsed by the task and their rows stored on the shards.
+"""
+
+import datetime
+import gzip
+import json
+import StringIO
+import unicodecsv as csv
+from collections import OrderedDict
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# How much of a file is read to sniff its dialect
+SNIFF_SAMPLE_SIZE = 64 * 1024
+
+# The key of a row which couldn't be read, holding the reason. The shard
+# reports it as an error instead of validating it.
+READ_ERROR_KEY = "_osmosis_read_error"
+
+DIALECT_ATTRS = (
+    "delimiter",
+    "doublequote",
+    "escapechar",
+    "lineterminator",
+    "quotechar",
+    "quoting",
+    "skipinitialspace"
+)
+
+
+def dialect_attributes(dialect):
+    """
+    The attributes of a csv.Dialect as a dict, which can be given as keyword
+    arguments to csv.reader and csv.writer. `dialect` can also be a dict of
+    just the attributes which differ from csv.excel.
+    """
+    attrs = {x: getattr(csv.excel, x) for x in DIALECT_ATTRS}
+    if isinstance(dialect, dict):
+        attrs.update(dialect)
+    else:
+        attrs.update({x: getattr(dialect, x) for x in DIALECT_ATTRS})
+    return attrs
+
+
+_READERS = []
+
+
+def register_reader(reader_class):
+    """
+    Make a SourceReader available for files with its extensions
+    or content types. Can be used as a class decorator.
+    """
+    _READERS.insert(0, reader_class)
+    return reader_class
+
+
+def get_reader_class(filename="", content_type=None, default=None):
+    """
+    The registered reader for the file. The longest matching extension wins,
+    then the content type, and if neither match the default (CSVReader).
+    Readers registered later take precedence over earlier ones.
+    """
+    filename = (filename or "").lower()
+    best, best_length = None, 0
+    for reader_class in _READERS:
+        for extension in reader_class.extensions:
+            if filename.endswith(extension) and len(extension) > best_length:
+                best, best_length = reader_class, len(extension)
+
+    if best is None and content_type:
+        for reader_class in _READERS:
+            if content_type in reader_class.content_types:
+                return reader_class
+
+    return best or default or CSVReader
+
+
+class _TrackedLines(object):
+    """
+    Iterates over the lines of a file handle, keeping track of the
+    byte offset of the end of the last line read. csv.reader only pulls
+    as many lines as it needs for a row, so after each row `position` is
+    the offset of the start of the next one.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.position = handle.tell()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.handle.readline()
+        if not line:
+            raise StopIteration
+        self.position += len(line)
+        return line
+
+
+def _scan_for_row_boundary(text, in_quotes, dialect):
+    """
+    Scan `text` assuming it starts inside (or outside) a quoted field. Returns
+    the offset just after the first line break which isn't inside quotes, or
+    False if the text can't be valid CSV under that assumption.
+    """
+    quote = dialect["quotechar"]
+    field_starts = (dialect["delimiter"], "\r", "\n", " ") if dialect["skipinitialspace"] else (dialect["delimiter"], "\r", "\n")
+    boundary = None
+
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if dialect["escapechar"] and c == dialect["escapechar"]:
+            i += 2
+            continue
+
+        if in_quotes:
+            if c == quote:
+                if dialect["doublequote"] and text[i + 1:i + 2] == quote:
+                    i += 2  # An escaped quote
+                    continue
+                in_quotes = False
+                # A closing quote has to be the end of the field
+                if text[i + 1:i + 2] not in ("", dialect["delimiter"], "\r", "\n"):
+                    return False
+        elif c == quote:
+            # An opening quote has to be the start of the field
+            if i and text[i - 1] not in field_starts:
+                return False
+            in_quotes = True
+        elif c == "\n" and boundary is None:
+            boundary = i + 1
+        i += 1
+
+    return boundary
+
+
+def _find_row_boundary(handle, offset, dialect, column_count, window=65536):
+    """
+    Find the start of the first row at or after `offset` in the CSV file
+    `handle`, without reading the file up to that point. A quoted field can
+    contain line breaks, so we consider both the possibility that `offset`
+    is inside quotes and outside, and discard the one that leads to invalid
+    CSV or rows with the wrong number of columns.
+
+    Returns None if the boundary can't be determined from `window` bytes.
+    """
+    handle.seek(offset)
+    text = handle.read(window)
+
+    candidates = []
+    for in_quotes in (False, True):
+        boundary = _scan_for_row_boundary(text, in_quotes, dialect)
+        if not boundary:
+            continue
+
+        # Check the complete rows following the boundary have the right number of columns
+        rows = list(csv.reader(StringIO.StringIO(text[boundary:]), **dialect))[:-1]
+        if all([len(row) == column_count for row in rows]):
+            candidates.append(boundary)
+
+    if len(candidates) != 1:
+        return None
+    return offset + candidates[0]
+
+
+class SourceReader(object):
+    """
+    Reads rows from a source file handle. `columns` and `dialect` are stored on
+    the task after the header has been read, and passed back to the readers of
+    each shard, which start reading part way through the file. Formats which
+    have to be sniffed read at most `sample_size` bytes to do so.
+    """
+    extensions = ()
+    content_types = ()
+    byte_ranges = False
+
+    def __init__(self, handle, columns=None, dialect=None, sample_size=SNIFF_SAMPLE_SIZE):
+        self.handle = handle
+        self.columns = columns
+        self.dialect = dialect or {}
+        self.sample_size = sample_size
+
+    @property
+    def position(self):
+        """
+        The byte offset of the start of the next row, only needed with `byte_ranges`
+        """
+        raise NotImplementedError()
+
+    def read_header(self):
+        """
+        Read the header and return the column names
+        """
+        raise NotImplementedError()
+
+    def read_row(self):
+        """
+        Return the next row as a dict, None at the end of the file
+        or False for a row which should be skipped
+        """
+        raise NotImplementedError()
+
+    def find_row_boundary(self, offset):
+        """
+        The offset of the start of the first row at or after `offset`, or None
+        if it can't be found. Only needed with `byte_ranges`.
+        """
+        raise NotImplementedError()
+
+
+@register_reader
+class CSVReader(SourceReader):
+    extensions = (".csv", ".txt")
+    content_types = ("text/csv", "text/plain", "application/csv")
+    byte_ranges = True
+
+    def __init__(self, handle, columns=None, dialect=None, sample_size=SNIFF_SAMPLE_SIZE):
+        super(CSVReader, self).__init__(self._open(handle), columns, dialect, sample_size)
+        if not self.dialect:
+            self.dialect = self._sniff()
+
+        self.lines = _TrackedLines(self.handle)
+        self.reader = csv.reader(self.lines, **self.dialect)
+
+    def _open(self, handle):
+        return handle
+
+    def _sniff(self):
+        pos = self.handle.tell()
+        self.handle.seek(0)
+        readahead = self.handle.read(self.sample_size)
+        self.handle.seek(pos)
+
+        if len(readahead) == self.sample_size:
+            # Only sniff complete lines, a partial one can throw the sniffer off
+            end = readahead.rfind("\n")
+            if end > 0:
+                readahead = readahead[:end + 1]
+
+        try:
+            dialect = csv.Sniffer().sniff(readahead, ",")
+        except csv.Error:
+            # Fallback to excel format
+            dialect = csv.excel
+
+        return dialect_attributes(dialect)
+
+    @property
+    def position(self):
+        return self.lines.position
+
+    def read_header(self):
+        self.columns = self.reader.next()
+        return self.columns
+
+    def read_row(self):
+        try:
+            values = self.reader.next()
+        except StopIteration:
+            return None
+
+        if not values:
+            return None
+
+        return dict(zip(self.columns, values))
+
+    def find_row_boundary(self, offset):
+        return _find_row_boundary(self.handle, offset, self.dialect, len(self.columns))
+
+
+@register_reader
+class GzipCSVReader(CSVReader):
+    """
+    Reads a gzip compressed CSV file, decompressing it as it goes. Compressed
+    files can only be read from the start, so they can't be split by byte range.
+    """
+    extensions = (".csv.gz", ".csv.gzip")
+    content_types = ("application/gzip", "application/x-gzip")
+    byte_ranges = False
+
+    def _open(self, handle):
+        return gzip.GzipFile(fileobj=handle, mode="rb")
+
+
+@register_reader
+class JSONLinesReader(SourceReader):
+    """
+    Reads a file with a JSON object on each line. The columns are the keys
+    of the first object, and blank lines are skipped. Lines which aren't JSON
+    objects are row errors, with the line in the first column.
+    """
+    extensions = (".jsonl", ".ndjson")
+    content_types = ("application/jsonl", "application/x-ndjson", "application/x-jsonlines")
+    byte_ranges = True
+
+    def __init__(self, handle, columns=None, dialect=None, sample_size=SNIFF_SAMPLE_SIZE):
+        super(JSONLinesReader, self).__init__(handle, columns, dialect, sample_size)
+        self.lines = _TrackedLines(self.handle)
+
+    @property
+    def position(self):
+        return self.lines.position
+
+    def read_header(self):
+        # There's no header line, so read the first object and go back to it
+        start = self.lines.position
+        row = None
+        for line in self.lines:
+            if line.strip():
+                try:
+                    row = json.loads(line, object_pairs_hook=OrderedDict)
+                except ValueError:
+                    pass
+                break
+
+        self.handle.seek(start)
+        self.lines = _TrackedLines(self.handle)
+        self.columns = row.keys() if isinstance(row, dict) else []
+        return self.columns
+
+    def read_row(self):
+        try:
+            line = self.lines.next()
+        except StopIteration:
+            return None
+
+        if not line.strip():
+            return False
+
+        try:
+            row = json.loads(line)
+        except ValueError, e:
+            return self._read_error(line, "Invalid JSON: {0}".format(e))
+        if not isinstance(row, dict):
+            return self._read_error(line, "Not a JSON object")
+        if not row:
+            return False  # Empty objects
+        return row
+
+    def _read_error(self, line, message):
+        row = {READ_ERROR_KEY: message}
+        if self.columns:
+            row[self.columns[0]] = line.strip()
+        return row
+
+    def find_row_boundary(self, offset):
+        if not offset:
+            return 0
+
+        # JSON strings can't contain line breaks, so every one is a boundary
+        self.handle.seek(offset - 1)
+        self.handle.readline()
+        return self.handle.tell()
+
+
+def _cell_value(value):
+    """
+    The string value of a spreadsheet cell, as it would appear in a CSV file
+    """
+    if value is None:
+        return u""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return unicode(value)
+
+
+@register_reader
+class XLSXReader(SourceReader):
+    """
+    Reads the first worksheet of an Excel file with openpyxl's read only
+    mode, which streams the rows rather than loading the whole sheet. The
+    first row is the header and empty rows are skipped.
+    """
+    extensions = (".xlsx",)
+    content_types = ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",)
+    byte_ranges = False
+
+    def __init__(self, handle, columns=None, dialect=None, sample_size=SNIFF_SAMPLE_SIZE):
+        if openpyxl is None:
+            raise ImportError("openpyxl is required to import .xlsx files")
+
+        super(XLSXReader, self).__init__(handle, columns, dialect, sample_size)
+        workbook = openpyxl.load_workbook(handle, read_only=True, data_only=True)
+        self.rows = workbook.worksheets[0].iter_rows()
+
+    def _values(self):
+        try:
+            row = next(self.rows)
+        except StopIteration:
+            return None
+        return [_cell_value(cell.value) for cell in row]
+
+    def read_header(self):
+        values = self._values() or []
+        while values and not values[-1]:
+            values.pop()  # Trailing empty cells
+        self.columns = values
+        return self.columns
+
+    def read_row(self):
+        values = self._values()
+        if values is None:
+            return None
+        if not any(values):
+            return False
+        return dict(zip(self.columns, values))
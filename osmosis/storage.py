@@ -0,0 +1,308 @@
+"""
+Backends which store the files of an import: reading the uploaded source
+file, and writing, combining and deleting the error CSVs.
+
+The backend is chosen with Osmosis.storage. The default, CloudStorage, keeps
+the error files in the app's default Google Cloud Storage bucket. LocalStorage
+keeps everything on the local disk and memory maps the source file, so that
+an import can be run and profiled on a development machine.
+"""
+
+import errno
+import mmap
+import os
+import shutil
+import threading
+
+from google.appengine.api.app_identity import get_default_gcs_bucket_name
+from google.appengine.ext.blobstore import create_gs_key
+
+import cloudstorage
+
+# Size of the reads when concatenating files
+COPY_CHUNK_SIZE = 1024 * 1024
+# Buffer size of files written to the local disk
+WRITE_BUFFER_SIZE = 256 * 1024
+# How many files to delete in parallel
+DELETE_BATCH_SIZE = 20
+
+
+class _RangedFile(object):
+    """
+    A read only view of the bytes between `start` and `end` of a file handle.
+    Offsets are those of the whole file, so seek() and tell() can be used with
+    the offsets stored on a shard.
+    """
+    def __init__(self, handle, start=0, end=None, size=None):
+        self.handle = handle
+        self.start = start
+        self.end = end
+        self.size = size if end is None else end
+        self.handle.seek(start)
+
+    def _remaining(self):
+        if self.end is None:
+            return None
+        return max(self.end - self.handle.tell(), 0)
+
+    def read(self, size=-1):
+        remaining = self._remaining()
+        if remaining is not None and (size < 0 or size > remaining):
+            size = remaining
+        return self.handle.read(size)
+
+    def readline(self):
+        remaining = self._remaining()
+        if remaining == 0:
+            return ""
+
+        line = self.handle.readline()
+        if remaining is not None and len(line) > remaining:
+            line = line[:remaining]
+            self.handle.seek(self.end)
+        return line
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.handle.seek(offset, whence)
+
+    def tell(self):
+        return self.handle.tell()
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Storage(object):
+    """
+    Reads and writes the files of an import. Filenames are those returned by path().
+    """
+    def path(self, *parts):
+        """
+        The filename of a file in this storage, e.g. path("osmosis-errors", "1.csv")
+        """
+        raise NotImplementedError()
+
+    def open_source(self, field_file, start=0, end=None):
+        """
+        A file handle for the uploaded source file (a FieldFile), positioned at
+        `start`. It must support read, readline, seek and tell, and have a `size`.
+        """
+        field_file.seek(start)
+        return field_file
+
+    def open(self, filename, start=0, end=None):
+        """
+        Open a file for reading, optionally just the bytes from `start` to `end`
+        """
+        raise NotImplementedError()
+
+    def writer(self, filename):
+        """
+        A buffered file handle for writing, to be used as a context manager.
+        The file should only appear once it has been closed.
+        """
+        raise NotImplementedError()
+
+    def compose(self, filenames, destination, header=""):
+        """
+        Write `header` followed by the contents of each of the files to `destination`
+        """
+        with self.writer(destination) as f:
+            f.write(header)
+            for filename in filenames:
+                with self.open(filename) as source:
+                    shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+
+    def delete(self, filenames):
+        """
+        Delete the files, ignoring any which don't exist
+        """
+        raise NotImplementedError()
+
+    def file_field_name(self, filename):
+        """
+        The name to store in AbstractImportTask.error_csv for the error CSV
+        """
+        return filename
+
+
+class CloudStorage(Storage):
+    """
+    Stores files in a Google Cloud Storage bucket, by default the app's
+    default bucket. Where the cloudstorage library supports it, files are
+    composed in GCS rather than being copied through the instance.
+    """
+    # GCS limits how many files can be composed at once, and in total
+    MAX_COMPOSE_FILES = 32
+    MAX_COMPOSE_COMPONENTS = 1024
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+
+    def path(self, *parts):
+        return "/" + "/".join((self.bucket or get_default_gcs_bucket_name(),) + parts)
+
+    def open(self, filename, start=0, end=None):
+        handle = cloudstorage.open(filename)
+        if not start and end is None:
+            return handle
+        return _RangedFile(handle, start, end)
+
+    def writer(self, filename):
+        return cloudstorage.open(filename, "w")
+
+    def _object_name(self, filename):
+        # cloudstorage.compose wants the sources without the bucket
+        return filename.split("/", 2)[2]
+
+    def _compose(self, filenames, destination, intermediates):
+        """
+        Compose the files into `destination`, in rounds of MAX_COMPOSE_FILES.
+        The intermediate files, which need deleting, are added to `intermediates`.
+        """
+        while len(filenames) > self.MAX_COMPOSE_FILES:
+            parts = []
+            for i in xrange(0, len(filenames), self.MAX_COMPOSE_FILES):
+                group = filenames[i:i + self.MAX_COMPOSE_FILES]
+                if len(group) == 1:
+                    parts.extend(group)
+                    continue
+
+                part = "%s.part-%s-%s" % (destination, len(intermediates), i)
+                cloudstorage.compose([self._object_name(x) for x in group], part)
+                parts.append(part)
+                intermediates.append(part)
+            filenames = parts
+
+        cloudstorage.compose([self._object_name(x) for x in filenames], destination)
+
+    def compose(self, filenames, destination, header=""):
+        if not hasattr(cloudstorage, "compose") or len(filenames) >= self.MAX_COMPOSE_COMPONENTS:
+            return super(CloudStorage, self).compose(filenames, destination, header)
+
+        header_filename = destination + ".header"
+        with self.writer(header_filename) as f:
+            f.write(header)
+
+        intermediates = []
+        try:
+            self._compose([header_filename] + list(filenames), destination, intermediates)
+        finally:
+            self.delete([header_filename] + intermediates)
+
+    def _delete(self, filename):
+        try:
+            cloudstorage.delete(filename)
+        except cloudstorage.NotFoundError:
+            pass  # Already deleted by a previous attempt
+
+    def delete(self, filenames):
+        """
+        Delete the files, DELETE_BATCH_SIZE at a time in parallel
+        """
+        for i in xrange(0, len(filenames), DELETE_BATCH_SIZE):
+            threads = [
+                threading.Thread(target=self._delete, args=(filename,))
+                for filename in filenames[i:i + DELETE_BATCH_SIZE]
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    def file_field_name(self, filename):
+        # A blobstore key for the GCS file
+        return '%s/errors.csv' % create_gs_key('/gs%s' % filename)
+
+
+class _LocalWriter(object):
+    """
+    Writes to a temporary file, which is renamed into place when closed
+    """
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = "%s.%s-%s.tmp" % (path, os.getpid(), threading.current_thread().ident)
+        self.handle = open(self.temp_path, "wb", WRITE_BUFFER_SIZE)
+
+    def write(self, data):
+        self.handle.write(data)
+
+    def close(self):
+        if not self.handle.closed:
+            self.handle.close()
+            os.rename(self.temp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.handle.close()
+            os.remove(self.temp_path)
+
+
+class LocalStorage(Storage):
+    """
+    Stores files under a directory on the local disk, by default MEDIA_ROOT.
+    Source files are memory mapped, so processes reading the same file share it.
+    """
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        if self._root is None:
+            from django.conf import settings
+            self._root = settings.MEDIA_ROOT
+        return self._root
+
+    def path(self, *parts):
+        return "/".join(parts)
+
+    def _full_path(self, filename):
+        return os.path.join(self.root, filename.lstrip("/"))
+
+    def _open_mapped(self, path, start, end):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                # Empty files can't be mapped
+                return _RangedFile(open(path, "rb"), start, end, size=0)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return _RangedFile(mapped, start, end, size=size)
+
+    def open_source(self, field_file, start=0, end=None):
+        try:
+            path = field_file.path
+        except NotImplementedError:
+            # Not stored on the local disk
+            return super(LocalStorage, self).open_source(field_file, start, end)
+        return self._open_mapped(path, start, end)
+
+    def open(self, filename, start=0, end=None):
+        return self._open_mapped(self._full_path(filename), start, end)
+
+    def writer(self, filename):
+        path = self._full_path(filename)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        return _LocalWriter(path)
+
+    def delete(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(self._full_path(filename))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
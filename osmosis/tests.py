@@ -1,15 +1,41 @@
 #STANDARD LIB
 from contextlib import nested
+import gzip
+import itertools
+import json
+import os
+import random
+import shutil
 import StringIO
+import tempfile
+import unittest
 
 # LIBRARIES
 from django import forms
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db.models import signals
 from django.test import TestCase
+from google.appengine.ext import deferred
 import mock
 
 # OSMOSIS
-from osmosis.forms import BooleanInterpreterMixin
-from osmosis.models import ImportTask, ImportShard, ImportStatus
+from osmosis import benchmark, metrics
+from osmosis.benchmark import BenchmarkImportTask, CountingExecutor, generate_csv, run_benchmark
+from osmosis.executors import ProcessPoolExecutor, SynchronousExecutor, ThreadPoolExecutor, _unpack
+from osmosis.forms import BooleanInterpreterMixin, can_rebind, FormPrototype
+from osmosis.models import (
+    ImportTask, ImportShard, ImportShardError, ImportStatus, ModelImportTaskMixin, ShardedCounter, ShardSource,
+    in_transaction, transactional
+)
+from osmosis.metrics import Timings
+from osmosis.payload import decode_columns, decode_rows, encode_rows
+from osmosis.readers import (
+    CSVReader, GzipCSVReader, JSONLinesReader, READ_ERROR_KEY, XLSXReader, _find_row_boundary,
+    dialect_attributes, get_reader_class, openpyxl
+)
+from osmosis.storage import CloudStorage, LocalStorage
+from osmosis.unique import DuplicateDetector, UniqueKey
 
 
 TEST_FILE_ONE = StringIO.StringIO()
@@ -24,6 +50,39 @@ value1, value2, value3
 TEST_FILE_ONE.seek(0)
 
 
+class ModelImportTask(ModelImportTaskMixin, ImportTask):
+    class Meta:
+        proxy = True
+        app_label = "osmosis"
+
+
+class SynchronousImportTask(ImportTask):
+    class Meta:
+        proxy = True
+        app_label = "osmosis"
+
+    class Osmosis:
+        executor = SynchronousExecutor
+
+
+class CountingImportTask(SynchronousImportTask):
+    class Meta:
+        proxy = True
+        app_label = "osmosis"
+
+    # Subclasses its parent's Osmosis, but still gets its own executor
+    class Osmosis(SynchronousImportTask.Osmosis):
+        executor = CountingExecutor
+
+
+class FakeCloudStorageFile(StringIO.StringIO):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
 class ImportTaskTests(TestCase):
     def test_start_defers_process(self):
         patches = [
@@ -39,17 +98,162 @@ class ImportTaskTests(TestCase):
         task = ImportTask()
 
         patches = [
-            mock.patch('google.appengine.ext.deferred.defer'),
-            mock.patch('osmosis.models.ImportShard.objects.create'),
+            mock.patch('google.appengine.api.taskqueue.Queue.add'),
+            mock.patch('osmosis.models.ImportShard.objects.bulk_create'),
+            mock.patch('osmosis.models.ImportShard.save'),
             mock.patch('osmosis.models.ImportTask.objects.get', side_effect=lambda *args, **kwargs: task),
-            mock.patch('osmosis.models.ImportTask.save')
+            mock.patch('osmosis.models.ImportTask.objects.filter'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models._bulk_insert_returns_ids', return_value=True),
         ]
 
-        with nested(*patches) as (mock_def, mock_create, mock_get, mock_save):
+        with nested(*patches) as (mock_add, mock_bulk_create, mock_shard_save, mock_get, mock_filter, mock_save, _):
             task.Osmosis.rows_per_shard = 1
-            task.source_data = TEST_FILE_ONE
+            task.source_data = StringIO.StringIO(TEST_FILE_ONE.getvalue())
+            task.process()
+
+            # All the shards are created and queued together
+            self.assertEqual(1, mock_bulk_create.call_count)
+            self.assertEqual(5, len(mock_bulk_create.call_args[0][0]))
+            self.assertFalse(mock_shard_save.called)
+            self.assertEqual(1, mock_add.call_count)
+            self.assertEqual(5, len(mock_add.call_args[0][0]))
+            self.assertEqual(5, task.shard_count)
+
+    def test_shards_saved_individually_without_bulk_insert_ids(self):
+        task = ImportTask()
+
+        patches = [
+            mock.patch('google.appengine.api.taskqueue.Queue.add'),
+            mock.patch('osmosis.models.ImportShard.objects.bulk_create'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportTask.objects.get', side_effect=lambda *args, **kwargs: task),
+            mock.patch('osmosis.models.ImportTask.objects.filter'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models._bulk_insert_returns_ids', return_value=False),
+            mock.patch.object(ImportTask.Osmosis, 'rows_per_shard', 1),
+        ]
+
+        with nested(*patches) as (mock_add, mock_bulk_create, mock_shard_save, _, _, _, _, _):
+            task.source_data = StringIO.StringIO(TEST_FILE_ONE.getvalue())
+            task.process()
+
+        # Each shard is inserted once
+        self.assertFalse(mock_bulk_create.called)
+        self.assertEqual(5, mock_shard_save.call_count)
+        self.assertEqual(1, mock_add.call_count)
+
+    def test_shards_created_in_one_batch_with_allocated_ids(self):
+        task = ImportTask(id=1)
+        task.timings = Timings()
+        shards = [ImportShard(task_id=task.pk, task_model_path=task.model_path, total_rows=1) for i in range(3)]
+
+        patches = [
+            mock.patch('osmosis.models._uses_datastore', return_value=True),
+            mock.patch('osmosis.models.db.allocate_ids', return_value=(100, 102)),
+            mock.patch('osmosis.models._bulk_insert_returns_ids', return_value=False),
+            mock.patch('osmosis.models.ImportShard.objects.bulk_create'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportTask._store_source_format'),
+            mock.patch('osmosis.models.ImportTask.defer_many'),
+        ]
+        with nested(*patches) as (_, mock_allocate_ids, _, mock_bulk_create, mock_save, _, mock_defer_many):
+            task._create_shards(shards)
+
+        self.assertEqual(3, mock_allocate_ids.call_args[0][1])
+        self.assertEqual(1, mock_bulk_create.call_count)
+        self.assertFalse(mock_save.called)
+        self.assertEqual([100, 101, 102], [shard.pk for shard in mock_bulk_create.call_args[0][0]])
+        self.assertEqual([100, 101, 102], [kallable.im_self.pk for kallable in mock_defer_many.call_args[0][0]])
+
+    def test_byte_range_shards_read_their_own_rows(self):
+        task = ImportTask()
+        source = StringIO.StringIO(TEST_FILE_ONE.getvalue())
+        created = []
+
+        patches = [
+            mock.patch('google.appengine.api.taskqueue.Queue.add'),
+            mock.patch('osmosis.models.ImportShard.objects.bulk_create', side_effect=created.extend),
+            mock.patch('osmosis.models._bulk_insert_returns_ids', return_value=True),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportTask.objects.get', side_effect=lambda *args, **kwargs: task),
+            mock.patch('osmosis.models.ImportTask.objects.filter'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch.object(ImportTask.Osmosis, 'rows_per_shard', 2),
+            mock.patch.object(ImportTask.Osmosis, 'shard_source', ShardSource.BYTE_RANGE),
+        ]
+
+        with nested(*patches):
+            task.source_data = source
             task.process()
-            self.assertEqual(5, mock_create.call_count)
+
+        self.assertEqual([2, 2, 1], [shard.total_rows for shard in created])
+        # The rows are numbered from 1, including those of the shard cut short by the end of the file
+        self.assertEqual([1, 3, 5], [shard.start_line_number for shard in created])
+        self.assertFalse(any(shard.source_data_json for shard in created))
+
+        rows = []
+        for shard in created:
+            rows.extend(data for data, end in shard._source_rows(task))
+        self.assertEqual(5, len(rows))
+        self.assertEqual(3, len(rows[0]))
+
+    def test_byte_range_split_after_reading_ahead(self):
+        source = TEST_FILE_ONE.getvalue()
+        header, row = source.splitlines(True)[:2]
+        task = ImportTask(
+            id=1, status=ImportStatus.IN_PROGRESS, detected_columns_json='["Field1", "Field2", "Field3"]',
+            detected_dialect_json=json.dumps(dialect_attributes({}))
+        )
+        task.source_data = StringIO.StringIO(source)
+        shard = ImportShard(
+            id=1, task_id=task.pk, task_model_path=task.model_path, last_row_processed=0,
+            start_line_number=1, source_byte_start=len(header), source_byte_end=len(source)
+        )
+
+        def checkpoint(this, last_row_processed, total_rows=None, **kwargs):
+            this.last_row_processed = last_row_processed
+            return this
+
+        patches = [
+            mock.patch.object(ImportShard, 'save', autospec=True),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch('osmosis.models.ImportTask.current_status', return_value=ImportStatus.IN_PROGRESS),
+            mock.patch('osmosis.models.ShardedCounter.increment'),
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+            mock.patch.object(ImportShard, '_checkpoint', autospec=True, side_effect=checkpoint),
+            # Every call to time.time() is 10 seconds later, so the shard splits after its first row
+            mock.patch('osmosis.models.time.time', side_effect=itertools.count(0, 10)),
+            mock.patch.object(ImportTask.Osmosis, 'target_shard_seconds', 1),
+            # Which is after the first 3 rows have been read ahead
+            mock.patch.object(ImportTask.Osmosis, 'lookup_prefetch_rows', 3),
+            mock.patch.object(ImportTask.Osmosis, 'unique_key', ["Field1"]),
+            mock.patch.object(ImportTask.Osmosis, 'detect_duplicates', False),
+        ]
+
+        with nested(*patches) as (mock_save, _, _, _, _, _, mock_import_row, _, _, _, _, _, _):
+            shard.process()
+
+        self.assertEqual(1, mock_import_row.call_count)
+        self.assertEqual(1, shard.total_rows)
+        self.assertEqual(len(header) + len(row), shard.source_byte_end)
+
+        new_shard = [c[0][0] for c in mock_save.call_args_list if c[0][0] is not shard][0]
+        self.assertEqual(len(header) + len(row), new_shard.source_byte_start)
+        self.assertEqual(len(source), new_shard.source_byte_end)
+        self.assertEqual(2, new_shard.start_line_number)
+        self.assertEqual(4, len(list(new_shard._source_rows(task))))
+
+    def test_find_row_boundary_skips_quoted_newlines(self):
+        dialect = dict(delimiter=",", quotechar='"', doublequote=True, escapechar=None,
+                       skipinitialspace=False, lineterminator="\r\n", quoting=0)
+        source = StringIO.StringIO('1,"a\nb\nc",2\n3,"d",4\n5,e,6\n')
+
+        # Offset 5 is inside the quoted field of the first row
+        self.assertEqual(12, _find_row_boundary(source, 5, dialect, 3))
+        self.assertEqual(20, _find_row_boundary(source, 12, dialect, 3))
 
     def test_shards_processed_updated(self):
 
@@ -73,26 +277,603 @@ class ImportTaskTests(TestCase):
                         with mock.patch('osmosis.models.ImportTask.objects.get', return_value=task):
                             shard1.process()
 
-                            self.assertEqual(1, task.shards_processed)
+                            self.assertEqual(1, task.progress()["shards_processed"])
 
                             shard1.process()
-                            self.assertEqual(1, task.shards_processed) #If the shard retries, don't increment again
+                            self.assertEqual(1, task.progress()["shards_processed"]) #If the shard retries, don't increment again
 
                             shard2.process()
-                            self.assertEqual(2, task.shards_processed)
+                            self.assertEqual(2, task.progress()["shards_processed"])
+
+    def test_shard_checkpoints_every_n_rows(self):
+        task = ImportTask()
+        shard = ImportShard(task_id=task.pk, task_model_path=task.model_path,
+                            id=1, source_data_json="[{}, {}, {}]", total_rows=3)
+
+        def checkpoint(this, last_row_processed, **kwargs):
+            this.last_row_processed = last_row_processed
+            return this
+
+        patches = [
+            mock.patch('google.appengine.ext.deferred.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch.object(ImportShard, '_checkpoint', autospec=True, side_effect=checkpoint),
+            mock.patch.object(ImportTask.Osmosis, 'checkpoint_rows', 2),
+        ]
+
+        with nested(*patches) as (_, _, _, _, _, _, mock_checkpoint, _):
+            shard.process()
+
+        # One checkpoint after the first two rows, and a final one for the remainder
+        self.assertEqual([2, 3], [c[0][1] for c in mock_checkpoint.call_args_list])
+        with mock.patch('osmosis.models.ImportTask.objects.get', return_value=task):
+            self.assertEqual(1, task.progress()["shards_processed"])
+
+    def test_dry_run_only_validates(self):
+        task = ImportTask(id=1, dry_run=True)
+        shard = ImportShard(id=1, task_id=task.pk, task_model_path=task.model_path, total_rows=3, start_line_number=1)
+        shard.source_data_json = encode_rows([{"a": "1"}, {"a": ""}, {"a": "3"}], ["a"])
+
+        class RequiredForm(forms.Form):
+            a = forms.CharField()
+
+        def checkpoint(this, last_row_processed, **kwargs):
+            this.last_row_processed = last_row_processed
+            return this
+
+        patches = [
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShardError.objects.bulk_create'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch('osmosis.models.ShardedCounter.increment'),
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+            mock.patch.object(ImportShard, '_checkpoint', autospec=True, side_effect=checkpoint),
+            mock.patch.object(ImportTask.Osmosis, 'forms', [RequiredForm]),
+        ]
+
+        with nested(*patches) as (_, mock_bulk_create, _, _, _, _, mock_import_row, mock_checkpoint, _):
+            shard.process()
+
+        self.assertFalse(mock_import_row.called)
+        # Just the one checkpoint at the end, rather than one per row
+        self.assertEqual(1, mock_checkpoint.call_count)
+        self.assertEqual([2], [error.line_number for error in mock_bulk_create.call_args[0][0]])
+        counts = mock_checkpoint.call_args[1]["counts"]
+        self.assertEqual({task._counter_name("rows_imported"): 2, task._counter_name("rows_errored"): 1}, counts)
+
+    def test_retry_errors_shards_failed_rows(self):
+        original = ImportTask.objects.create(
+            status=ImportStatus.FINISHED, detected_columns_json='["a", "b"]', detected_dialect_json='{}'
+        )
+        shards = [ImportShard.objects.create(task_id=original.pk, task_model_path=original.model_path) for i in range(2)]
+        ImportShardError.objects.create(shard=shards[1], line_number=40, line=json.dumps(["3", "", "b: Required"]))
+        ImportShardError.objects.create(shard=shards[0], line_number=7, line=json.dumps(["2", "", "b: Required"]))
+        ImportShardError.objects.create(shard=shards[0], line_number=3, line=json.dumps(["1", "", "b: Required"]))
+
+        patches = [
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.defer_many'),
+            mock.patch.object(ImportTask.Osmosis, 'rows_per_shard', 2),
+        ]
+        with nested(*patches) as (mock_defer, _, _):
+            task = original.retry_errors()
+            task.process()
+
+        self.assertEqual(task.process, mock_defer.call_args_list[0][0][0])
+        new_shards = ImportShard.objects.filter(task_id=task.pk).order_by("pk")
+        self.assertEqual([[3, 7], [40]], [json.loads(shard.line_numbers_json) for shard in new_shards])
+        self.assertEqual([{"a": "1", "b": ""}, {"a": "2", "b": ""}], list(decode_rows(new_shards[0].source_data_json)))
+        self.assertEqual(3, ImportTask.objects.get(pk=task.pk).row_count)
+
+        # The shards report errors against the original lines
+        class RequiredForm(forms.Form):
+            b = forms.CharField()
+
+        shard = new_shards[0]
+        patches = [
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportShard.handle_error'),
+            mock.patch.object(ImportTask.Osmosis, 'forms', [RequiredForm]),
+        ]
+        with nested(*patches) as (_, _, mock_handle_error, _):
+            shard.process()
+        self.assertEqual([3, 7], [c[0][0] for c in mock_handle_error.call_args_list])
+
+    def test_retry_rows_from_corrected_error_csv(self):
+        original = ImportTask.objects.create(
+            status=ImportStatus.FINISHED, detected_columns_json='["a", "b"]', detected_dialect_json='{}'
+        )
+        shard = ImportShard.objects.create(task_id=original.pk, task_model_path=original.model_path)
+        for lineno in (5, 9):
+            ImportShardError.objects.create(shard=shard, line_number=lineno, line=json.dumps(["1", "", "b: Required"]))
+
+        task = ImportTask(
+            retry_of_id=original.pk, detected_dialect_json=json.dumps(dialect_attributes({})), source_data="errors.csv"
+        )
+        corrected = "a,b,errors\r\n1,x,b: Required\r\n2,y,b: Required\r\n"
+        with mock.patch('osmosis.models.ImportTask.open_source_data', return_value=StringIO.StringIO(corrected)):
+            rows = list(task._retry_rows(original))
+        self.assertEqual([(5, {"a": "1", "b": "x"}), (9, {"a": "2", "b": "y"})], rows)
+
+        # If rows have been removed the lines can't be matched up, so they're the corrected file's
+        with mock.patch('osmosis.models.ImportTask.open_source_data', return_value=StringIO.StringIO(corrected.rsplit("2,y", 1)[0])):
+            self.assertEqual([1], [lineno for lineno, data in task._retry_rows(original)])
+
+    def test_errors_of_rows_with_the_same_line_number_are_kept(self):
+        # As in a retry of several pre-split shards, which each number their rows from 1
+        shard = ImportShard.objects.create(task_id=1, task_model_path="osmosis.ImportTask")
+        for row in (0, 1, 0):  # Row 0 written again by a retried task
+            ImportShardError.objects.create(shard=shard, row=row, line_number=5, line=json.dumps([str(row)]))
+        ImportShardError.objects.create(shard=shard, line_number=2, line=json.dumps(["old"]))
 
-    def test_finish_callback_deferred(self):
-        task = ImportTask(shard_count=1, shards_processed=1)
+        self.assertEqual([["old"], ["0"], ["1"]], [json.loads(error.line) for error in shard._get_errors()])
 
-        with mock.patch('django.db.models.Model.save') as save_patch:
-            with mock.patch('google.appengine.ext.deferred.defer') as def_patch:
-                task.save()
-                self.assertTrue(save_patch.called)
+    def test_finalizing_errors_queued_with_just_the_keys(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=1,
+            source_data_json=encode_rows([{"a": "1"}], ["a"])
+        )
 
-                task.status = ImportStatus.IN_PROGRESS
-                task.save()
+        patches = [
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+        ]
+        with nested(*patches) as (mock_defer, _):
+            shard.process()
+
+        finalize = mock_defer.call_args[0][0]
+        self.assertEqual("_finalize_errors", finalize.__name__)
+        self.assertEqual(shard.pk, finalize.im_self.pk)
+        self.assertEqual("", finalize.im_self.source_data_json)
+
+    def test_paused_shards_resume_from_checkpoint(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=2,
+            source_data_json=encode_rows([{"a": "1"}, {"a": "2"}], ["a"])
+        )
+
+        with mock.patch('osmosis.models.memcache', FakeMemcache()):
+            self.assertTrue(task.pause())
+            self.assertFalse(task.pause())
+            self.assertEqual(ImportStatus.PAUSED, task.current_status())
+
+            with mock.patch('osmosis.models.ImportTask.import_row') as mock_import_row:
+                shard.process()
+            self.assertFalse(mock_import_row.called)
+            self.assertTrue(ImportShard.objects.get(pk=shard.pk).paused)
+
+            # The shards are looked for in a task rather than by resume() itself
+            with mock.patch('osmosis.models.ImportTask.defer') as mock_defer:
+                self.assertTrue(task.resume())
+            self.assertEqual(ImportStatus.IN_PROGRESS, task.current_status())
+            self.assertTrue(ImportShard.objects.get(pk=shard.pk).paused)
+            unpause = mock_defer.call_args[0][0]
+            self.assertEqual("_unpause_shards", unpause.__name__)
+
+            with mock.patch('osmosis.models.ImportTask.defer_many') as mock_defer_many:
+                unpause()
+            self.assertFalse(ImportShard.objects.get(pk=shard.pk).paused)
+            self.assertEqual([shard.pk], [kallable.im_self.pk for kallable in mock_defer_many.call_args[0][0]])
+
+    def test_resume_looks_again_for_shards_it_missed(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=1,
+            source_data_json=encode_rows([{"a": "1"}], ["a"])
+        )
+
+        with mock.patch('osmosis.models.memcache', FakeMemcache()):
+            task.pause()
+            shard.process()
+            self.assertTrue(ImportShard.objects.get(pk=shard.pk).paused)
+
+            with mock.patch('osmosis.models.ImportTask.defer') as mock_defer:
+                self.assertTrue(task.resume())
+            unpause = mock_defer.call_args[0][0]
+
+            # An out of date query which doesn't find the paused shard
+            patches = [
+                mock.patch('osmosis.models.ImportShard.objects.filter', return_value=[]),
+                mock.patch('osmosis.models.ImportTask.defer'),
+                mock.patch('osmosis.models.ImportTask.defer_many'),
+            ]
+            with nested(*patches) as (_, mock_defer, _):
+                unpause()
+            self.assertTrue(ImportShard.objects.get(pk=shard.pk).paused)
+            retry = mock_defer.call_args[0][0]
+            self.assertEqual("_unpause_shards", retry.__name__)
+            self.assertIn("_countdown", mock_defer.call_args[1])
+
+            patches = [
+                mock.patch('osmosis.models.ImportTask.defer'),
+                mock.patch('osmosis.models.ImportTask.defer_many'),
+            ]
+            with nested(*patches) as (mock_defer, mock_defer_many):
+                retry()
+            self.assertFalse(ImportShard.objects.get(pk=shard.pk).paused)
+            # The shard is queued, and there's nothing left to look for
+            self.assertEqual([shard.pk], [kallable.im_self.pk for kallable in mock_defer_many.call_args[0][0]])
+            self.assertFalse(mock_defer.called)
+
+    def test_cancelled_shards_stop_at_next_checkpoint(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=3,
+            source_data_json=encode_rows([{"a": "1"}, {"a": "2"}, {"a": "3"}], ["a"])
+        )
+
+        patches = [
+            mock.patch('osmosis.models.memcache', FakeMemcache()),
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row', side_effect=lambda *args: task.cancel()),
+            mock.patch.object(ImportTask.Osmosis, 'status_check_seconds', 0),
+        ]
+        with nested(*patches) as (_, mock_defer, mock_import_row, _):
+            shard.process()
+
+            self.assertEqual(1, mock_import_row.call_count)
+            self.assertEqual(1, ImportShard.objects.get(pk=shard.pk).last_row_processed)
+            self.assertFalse(mock_defer.called)
+
+            # Cancelled imports don't finish
+            task.finish()
+            self.assertEqual(ImportStatus.CANCELLED, ImportTask.objects.get(pk=task.pk).status)
+            self.assertFalse(task.resume())
+
+    def test_dry_run_stops_with_a_checkpoint(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS, dry_run=True)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=3,
+            source_data_json=encode_rows([{"a": "1"}, {"a": "2"}, {"a": "3"}], ["a"])
+        )
+
+        def build_form(data):
+            task.cancel()
+            return forms.Form(data)
+
+        patches = [
+            mock.patch('osmosis.models.memcache', FakeMemcache()),
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.get_form_builders', return_value=[build_form]),
+            mock.patch.object(ImportTask.Osmosis, 'status_check_seconds', 0),
+        ]
+        with nested(*patches) as (_, mock_defer, _, _):
+            shard.process()
+
+        # Stopped after the first row, although dry runs don't checkpoint every row
+        self.assertEqual(1, ImportShard.objects.get(pk=shard.pk).last_row_processed)
+        self.assertFalse(mock_defer.called)
+
+    def test_shard_continues_before_deadline(self):
+        task = ImportTask(id=1)
+        shard = ImportShard(task_id=task.pk, task_model_path=task.model_path,
+                            id=1, source_data_json="[{}, {}, {}]", total_rows=3)
+
+        patches = [
+            mock.patch('google.appengine.ext.deferred.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch.object(ImportTask.Osmosis, 'shard_deadline_seconds', 60),
+            # The clock jumps past the deadline after the shard starts
+            mock.patch('osmosis.models.time.time', side_effect=itertools.chain([0], itertools.repeat(1000))),
+        ]
+
+        with nested(*patches) as (mock_defer, mock_import_row, _, _, _, _, _, _):
+            shard.process()
+
+        self.assertEqual(1, mock_import_row.call_count)
+        self.assertEqual(1, shard.last_row_processed)
+        self.assertEqual(1, shard.continuations)
+        self.assertFalse(shard.complete)
+        self.assertEqual(1, mock_defer.call_count)
+        with mock.patch('osmosis.models.ImportTask.objects.get', return_value=task):
+            self.assertEqual(1, task.progress()["continuations"])
+
+    def test_import_rows_errors_mapped_to_lines(self):
+        task = ImportTask()
+        shard = ImportShard(task_id=task.pk, task_model_path=task.model_path, id=1,
+                            source_data_json='[{"a": "1"}, {"a": "2"}, {"a": "3"}]',
+                            total_rows=3, start_line_number=2)
+
+        def import_row(forms, cleaned_data):
+            if cleaned_data["a"] == "2":
+                raise ValidationError("Bad row")
+
+        class RowForm(forms.Form):
+            a = forms.CharField()
+
+        patches = [
+            mock.patch('google.appengine.ext.deferred.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row', side_effect=import_row),
+            mock.patch('osmosis.models.ImportTask.handle_error'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShard._write_error_row'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch.object(ImportTask.Osmosis, 'forms', [RowForm]),
+            mock.patch.object(ImportTask.Osmosis, 'import_batch_size', 3),
+        ]
 
-                self.assertTrue(def_patch.called)
+        with nested(*patches) as (_, mock_import_row, mock_handle_error, _, _, _, _, _, _, _):
+            shard.process()
+
+        self.assertEqual(3, mock_import_row.call_count)
+        mock_handle_error.assert_called_once_with(3, {"a": "2"}, ["Bad row"])
+
+    def test_import_rows_retries_only_the_model_which_failed(self):
+        class ShardForm(forms.ModelForm):
+            class Meta:
+                model = ImportShard
+                fields = ('task_id', 'task_model_path')
+
+        class CounterForm(forms.ModelForm):
+            class Meta:
+                model = ShardedCounter
+                fields = ('id', 'count')
+
+        rows = []
+        for row, form in enumerate([
+            ShardForm({'task_id': '1', 'task_model_path': 'a'}),
+            CounterForm({'id': 'x', 'count': '1'}),
+            ShardForm({'task_id': '2', 'task_model_path': 'b'}),
+            CounterForm({'id': 'y', 'count': '2'}),
+        ]):
+            self.assertTrue(form.is_valid())
+            rows.append((row, [form], form.cleaned_data))
+
+        task = ModelImportTask()
+        with mock.patch('osmosis.models.ShardedCounter.objects.bulk_create', side_effect=IntegrityError):
+            self.assertEqual({}, task.import_rows(rows))
+
+        # The shards were saved in bulk once, and the counters one at a time
+        self.assertEqual(2, ImportShard.objects.count())
+        self.assertEqual(2, ShardedCounter.objects.count())
+
+        # Models with signal receivers are never saved in bulk
+        receiver = mock.Mock()
+        signals.post_save.connect(receiver, sender=ImportShard)
+        self.addCleanup(signals.post_save.disconnect, receiver, sender=ImportShard)
+        self.assertFalse(task._can_bulk_save(ShardForm({'task_id': '3', 'task_model_path': 'c'})))
+
+    def test_errors_written_in_batches(self):
+        task = ImportTask(detected_columns_json='["a", "b"]')
+        shard = ImportShard(task_id=task.pk, task_model_path=task.model_path, id=1,
+                            source_data_json='[{"b": "1"}, {"b": "2"}, {"b": "3"}]', total_rows=3)
+
+        class RequiredForm(forms.Form):
+            a = forms.CharField()
+
+        patches = [
+            mock.patch('google.appengine.ext.deferred.defer'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShardError.objects.bulk_create'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch.object(ImportTask.Osmosis, 'forms', [RequiredForm]),
+            mock.patch.object(ImportTask.Osmosis, 'checkpoint_rows', 2),
+        ]
+
+        with nested(*patches) as (_, _, _, mock_bulk_create, _, _, _, _):
+            shard.process()
+
+        # Errors are saved at each checkpoint
+        batches = [c[0][0] for c in mock_bulk_create.call_args_list]
+        self.assertEqual([2, 1], [len(batch) for batch in batches])
+        self.assertEqual([2], [error.line_number for error in batches[1]])
+        self.assertEqual(["", "3"], json.loads(batches[1][0].line)[:2])
+
+    def test_task_fetched_once_per_shard(self):
+        task = ImportTask()
+        shard = ImportShard(task_id=task.pk, task_model_path=task.model_path, id=1,
+                            source_data_json='[{}, {}, {}, {}]', total_rows=4)
+
+        class RequiredForm(forms.Form):
+            a = forms.CharField()
+
+        patches = [
+            mock.patch('google.appengine.ext.deferred.defer'),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShardError.objects.bulk_create'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch.object(ImportTask.Osmosis, 'forms', [RequiredForm]),
+        ]
+
+        with nested(*patches) as (_, _, _, mock_bulk_create, _, _, _):
+            shard.process()
+
+        # Every row was an error, but the task was only loaded once
+        self.assertEqual(4, sum(len(c[0][0]) for c in mock_bulk_create.call_args_list))
+        self.assertEqual(1, shard.task_fetches)
+
+        shard.task_id = 2
+        shard.task
+        self.assertEqual(2, shard.task_fetches)
+
+    def test_finish_concatenates_error_files(self):
+        task = ImportTask(id=1, detected_columns_json='["a", "b"]', status=ImportStatus.IN_PROGRESS)
+        storage = LocalStorage(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, storage.root)
+        for filename, content in [("shard-1.csv", "1,2,error\r\n"), ("shard-2.csv", "3,4,error\r\n")]:
+            with storage.writer(filename) as f:
+                f.write(content)
+
+        shards = mock.MagicMock()
+        shards.order_by.return_value = shards
+        values = {
+            ("error_csv_filename", "metrics_json"): [
+                ("shard-1.csv", Timings(counts={metrics.ROWS: 2}).to_json()),
+                ("", ""),
+                ("shard-2.csv", Timings(counts={metrics.ROWS: 3}).to_json()),
+            ],
+        }
+        # None of them were presplit, so there are no line numbers to rebase
+        shards.values_list.side_effect = lambda *fields: values.get(fields, [])
+
+        patches = [
+            mock.patch('osmosis.models.ImportShard.objects.filter', return_value=shards),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch('osmosis.models.ImportTask.save'),
+            mock.patch.object(ImportTask.Osmosis, '_storage_instance', storage, create=True),
+        ]
+
+        with nested(*patches):
+            task.finish()
+
+        with storage.open(task.error_csv_filename) as f:
+            self.assertEqual("a,b,errors\r\n1,2,error\r\n3,4,error\r\n", f.read())
+        self.assertEqual(ImportStatus.FINISHED, task.status)
+        self.assertEqual(["osmosis-errors"], os.listdir(storage.root))
+        self.assertEqual(5, json.loads(task.metrics_json)["counts"]["rows"])
+
+    def test_checkpoints_count_rows_once(self):
+        task = ImportTask(id=1)
+        shard = ImportShard(id=1, task_id=task.pk, task_model_path=task.model_path, total_rows=10)
+        counts = {task._counter_name("rows_imported"): 4}
+
+        patches = [
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+        ]
+
+        with nested(*patches):
+            stale = ImportShard(id=1, task_id=task.pk, task_model_path=task.model_path, total_rows=10)
+            shard._checkpoint(4, counts=counts)
+            # A retry which started before the first checkpoint was written
+            stale._checkpoint(4, counts=counts)
+
+            self.assertEqual(4, task.progress()["rows_imported"])
+
+    def test_rows_per_shard_from_history(self):
+        task = ImportTask(id=1)
+
+        patches = [
+            mock.patch.object(ImportTask.Osmosis, 'target_shard_seconds', 60),
+            mock.patch.object(ImportTask.Osmosis, 'max_rows_per_shard', 1000),
+        ]
+
+        with nested(*patches):
+            self.assertIsNone(task._history_row_seconds())
+
+            # 50ms a row
+            ShardedCounter.increment(task._history_counter_name("ms"), 5000)
+            ShardedCounter.increment(task._history_counter_name("rows"), 100)
+            self.assertEqual(0.05, task._history_row_seconds())
+            self.assertEqual(1000, task._rows_per_shard(0.05))  # 1200 is over the maximum
+            self.assertEqual(600, task._rows_per_shard(0.1))
+
+    def test_history_only_sampled_with_target_shard_seconds(self):
+        task = ImportTask(id=1)
+        history_names = [task._history_counter_name("ms"), task._history_counter_name("rows")]
+
+        def checkpoint(this, last_row_processed, **kwargs):
+            this.last_row_processed = last_row_processed
+            return this
+
+        for target_shard_seconds in [None, 600]:
+            shard = ImportShard(task_id=task.pk, task_model_path=task.model_path,
+                                id=1, source_data_json="[{}, {}, {}]", total_rows=3)
+            patches = [
+                mock.patch('osmosis.models.ImportTask.import_row'),
+                mock.patch('osmosis.models.ImportTask.defer'),
+                mock.patch('osmosis.models.ImportShard.save'),
+                mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+                mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+                mock.patch.object(ImportShard, '_checkpoint', autospec=True, side_effect=checkpoint),
+                mock.patch.object(ImportTask.Osmosis, 'target_shard_seconds', target_shard_seconds),
+            ]
+
+            with nested(*patches) as (_, _, _, _, _, mock_checkpoint, _):
+                shard.process()
+
+            # A checkpoint for every row, but only the last adds to the history
+            counts = [c[1]["counts"] for c in mock_checkpoint.call_args_list]
+            self.assertEqual(3, len(counts))
+            self.assertFalse(any(name in c for c in counts[:2] for name in history_names))
+            if target_shard_seconds:
+                self.assertEqual(3, counts[2][task._history_counter_name("rows")])
+            else:
+                self.assertFalse(any(name in counts[2] for name in history_names))
+
+    def test_counter_increment_when_created_concurrently(self):
+        name = "concurrent"
+        key = ShardedCounter._keys(name)[0]
+        ShardedCounter.objects.create(pk=key, count=5)
+        filter_counters = ShardedCounter.objects.filter
+        # The first update runs before someone else creates the counter
+        not_yet_created = mock.Mock(**{"update.return_value": 0})
+        stale = [not_yet_created]
+
+        patches = [
+            mock.patch('osmosis.models.random.choice', return_value=key),
+            mock.patch(
+                'osmosis.models.ShardedCounter.objects.filter',
+                side_effect=lambda **kwargs: stale.pop() if stale else filter_counters(**kwargs)
+            ),
+        ]
+        with nested(*patches):
+            # Creating it fails, so it's added to theirs
+            ShardedCounter.increment(name, 2)
+
+        ShardedCounter.increment(name, 3)
+        self.assertEqual({name: 10}, ShardedCounter.totals([name]))
+
+        self.assertTrue(ShardedCounter.claim("claimed"))
+        self.assertFalse(ShardedCounter.claim("claimed"))
+
+    def test_finish_deferred_once_by_last_shard(self):
+        task = ImportTask(id=1, shard_count=2, status=ImportStatus.IN_PROGRESS)
+
+        patches = [
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch('google.appengine.ext.deferred.defer'),
+        ]
+
+        with nested(*patches) as (_, mock_defer):
+            ShardedCounter.increment(task._counter_name("shards_finalized"))
+            task._check_finished()
+            self.assertFalse(mock_defer.called)
+
+            ShardedCounter.increment(task._counter_name("shards_finalized"))
+            task._check_finished()
+            task._check_finished()  # e.g. a retried shard
+            self.assertEqual(1, mock_defer.call_count)
+
+    def test_finish_deferred_without_the_source_reader(self):
+        task = ImportTask(id=1, shard_count=1, status=ImportStatus.IN_PROGRESS)
+        task.source_reader = CSVReader(StringIO.StringIO(TEST_FILE_ONE.getvalue()))
+        task.source_reader.read_header()
+        ShardedCounter.increment(task._counter_name("shards_finalized"))
+
+        patches = [
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch('google.appengine.ext.deferred.defer'),
+        ]
+
+        with nested(*patches) as (_, mock_defer):
+            task._check_finished()
+            task._shards_created(0)
+
+        self.assertEqual(2, mock_defer.call_count)
+        for call in mock_defer.call_args_list:
+            # The payload is pickled for real, which a csv reader can't be
+            self.assertTrue(deferred.deferred.serialize(*call[0]))
 
     def test_error_callback_on_error(self):
         pass
@@ -116,6 +897,499 @@ class ImportTaskTests(TestCase):
         pass
 
 
+class ExecutorTests(TestCase):
+    def test_synchronous_executor_runs_submissions_after_the_caller(self):
+        executor = SynchronousExecutor()
+        calls = []
+
+        def child():
+            calls.append("child")
+
+        def parent():
+            executor.submit(child, _queue="default")
+            calls.append("parent")
+
+        executor.submit(parent)
+        self.assertEqual(["parent", "child"], calls)
+
+    def test_synchronous_executor_waits_for_the_transaction(self):
+        executor = SynchronousExecutor()
+        calls = []
+
+        @transactional
+        def submit():
+            executor.submit(calls.append, "submitted")
+            calls.append("committing")
+
+        submit()
+        self.assertEqual(["committing", "submitted"], calls)
+
+        @transactional
+        def rolled_back():
+            executor.submit(calls.append, "rolled back")
+            raise ValueError()
+
+        self.assertRaises(ValueError, rolled_back)
+        self.assertEqual(["committing", "submitted"], calls)
+
+    def test_thread_pool_executor_waits_for_everything(self):
+        executor = ThreadPoolExecutor(2)
+        results = []
+
+        def fan_out():
+            for i in range(10):
+                executor.submit(results.append, i)
+
+        executor.submit(fan_out)
+        executor.join()
+        self.assertEqual(range(10), sorted(results))
+        self.assertEqual([], executor.errors)
+
+    def test_thread_pool_executor_queues_split_shard_once_committed(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=3,
+            source_data_json=encode_rows([{"a": "1"}, {"a": "2"}, {"a": "3"}], ["a"])
+        )
+        executor = ThreadPoolExecutor(2)
+        pool = mock.Mock()
+        submitted = []
+        pool.apply_async.side_effect = lambda func, args: submitted.append((in_transaction(), args[0]))
+
+        patches = [
+            mock.patch.object(executor, '_get_pool', return_value=pool),
+            mock.patch('osmosis.models.ImportTask.get_executor', return_value=executor),
+        ]
+        with nested(*patches):
+            shard._split(task, 1)
+
+        # The new shard is only handed to the pool once it has been saved
+        new_shard = ImportShard.objects.exclude(pk=shard.pk).get()
+        self.assertEqual([(False, new_shard.pk)], [(during, kallable.im_self.pk) for during, kallable in submitted])
+
+    def test_process_pool_executor_schedules_once_committed(self):
+        executor = ProcessPoolExecutor(2)
+        pool = mock.Mock()
+
+        @transactional
+        def rolled_back():
+            executor.submit(len, "abc")
+            raise ValueError()
+
+        @transactional
+        def committed():
+            executor.submit(len, "abc", _queue="default")
+            self.assertFalse(pool.apply_async.called)
+
+        with mock.patch.object(executor, '_get_pool', return_value=pool):
+            self.assertRaises(ValueError, rolled_back)
+            self.assertFalse(pool.apply_async.called)
+            committed()
+
+        self.assertEqual(1, pool.apply_async.call_count)
+        kallable, args, kwargs = _unpack(pool.apply_async.call_args[0][1][0])
+        self.assertEqual(3, kallable(*args, **kwargs))
+
+        # And for real
+        executor = ProcessPoolExecutor(2)
+        executor.submit(len, "abc")
+        executor.join()
+        executor.pool.close()
+        self.assertEqual([], executor.errors)
+
+    def test_task_uses_executor_from_meta(self):
+        executor = mock.Mock()
+        with mock.patch.object(ImportTask.Osmosis, '_executor_instance', None, create=True):
+            with mock.patch.object(ImportTask.Osmosis, 'executor', executor):
+                task = ImportTask()
+                task.defer(task.finish)
+                executor.submit.assert_called_once_with(task.finish, _queue=ImportTask.get_meta().queue)
+
+    def test_subclassed_meta_loads_its_own_executor(self):
+        self.assertIsInstance(SynchronousImportTask.get_executor(), SynchronousExecutor)
+        self.assertIsInstance(CountingImportTask.get_executor(), CountingExecutor)
+        self.assertIs(CountingImportTask.get_executor(), CountingImportTask.get_executor())
+
+
+def read_all(reader):
+    rows = []
+    while True:
+        row = reader.read_row()
+        if row is None:
+            return rows
+        rows.append(row)
+
+
+class MetricsTests(TestCase):
+    def test_timings_summary(self):
+        timings = Timings(started=100)
+        timings.add(metrics.QUEUE, 4)
+        timings.add(metrics.VALIDATE, 6)
+        timings.count(metrics.ROWS, 50)
+        timings.count(metrics.DATASTORE_CALLS, 100)
+        timings.count(metrics.SHARD_TASKS, 2)
+
+        summary = timings.summary(finished=110)
+        self.assertEqual(6, summary["busy_seconds"])
+        self.assertEqual(10, summary["elapsed_seconds"])
+        self.assertEqual(5, summary["rows_per_second"])
+        self.assertEqual(2, summary["datastore_calls_per_row"])
+        self.assertEqual(2, summary["queue_latency_seconds"])
+
+        # The summary can be loaded and added to
+        loaded = Timings.from_json(json.dumps(summary)).merge(Timings(counts={metrics.ROWS: 1}, started=90))
+        self.assertEqual(51, loaded.counts[metrics.ROWS])
+        self.assertEqual(90, loaded.started)
+
+    def test_timings_taken_and_reset(self):
+        timings = Timings()
+        rows = list(timings.timed(metrics.PARSE, iter([1, 2])))
+        timings.count(metrics.ROWS, len(rows))
+
+        taken = timings.take()
+        self.assertTrue(taken)
+        self.assertIn(metrics.PARSE, taken.seconds)
+        self.assertEqual(2, taken.counts[metrics.ROWS])
+        self.assertFalse(timings)
+
+    def test_shard_checkpoint_stores_timings(self):
+        task = ImportTask(id=1)
+        shard = ImportShard(id=1, task_id=task.pk, task_model_path=task.model_path, total_rows=2)
+        shard.source_data_json = encode_rows([{"a": "1"}, {"a": "2"}], ["a"])
+        shard.queued_at = 0
+
+        patches = [
+            mock.patch('osmosis.models.ImportShard.save'),
+            mock.patch('osmosis.models.ImportShard.objects.get', return_value=shard),
+            mock.patch('osmosis.models.ImportTask.objects.get', return_value=task),
+            mock.patch('osmosis.models.ShardedCounter.increment'),
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.get_form_builders', return_value=[]),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+            mock.patch.object(ImportTask.Osmosis, 'checkpoint_rows', 10),
+        ]
+
+        with nested(*patches):
+            shard.process()
+
+        stored = Timings.from_json(shard.metrics_json)
+        self.assertEqual(2, stored.counts[metrics.ROWS])
+        self.assertEqual(1, stored.counts[metrics.SHARD_TASKS])
+        self.assertTrue(stored.seconds[metrics.QUEUE] > 0)
+        self.assertIn(metrics.IMPORT, stored.seconds)
+
+
+class BenchmarkTests(TestCase):
+    def test_generated_file_is_reproducible(self):
+        first, second = StringIO.StringIO(), StringIO.StringIO()
+        generate_csv(first, 20, 3, error_rate=0.25, seed=1)
+        generate_csv(second, 20, 3, error_rate=0.25, seed=1)
+        self.assertEqual(first.getvalue(), second.getvalue())
+
+        rows = first.getvalue().splitlines()
+        self.assertEqual("number,column1,column2", rows[0])
+        self.assertEqual(5, len([x for x in rows[1:] if not x.split(",")[0].isdigit()]))
+
+    def test_benchmark_runs_whole_import(self):
+        results = run_benchmark(rows=30, columns=3, error_rate=0.1, rows_per_shard=10)
+
+        self.assertEqual(30, results["rows"])
+        self.assertEqual(3, results["rows_errored"])
+        self.assertEqual(3, results["shards"])
+        self.assertEqual(3, results["tasks"]["ImportShard.process"])
+        self.assertEqual(1, results["tasks"]["BenchmarkImportTask.finish"])
+        self.assertIn(metrics.VALIDATE, results["phase_seconds"])
+        self.assertFalse(ImportShard.objects.exists())
+        # Nothing is left behind for the next run
+        self.assertFalse(ShardedCounter.objects.exists())
+        self.assertEqual([], BenchmarkImportTask.get_meta().forms)
+
+    def test_presplit_file_imports_every_row_once(self):
+        imported = []
+        error_lines = []
+        cleanup = benchmark._cleanup
+
+        def record_errors(task):
+            for shard in ImportShard.objects.filter(task_id=task.pk, task_model_path=task.model_path):
+                error_lines.extend(error.line_number for error in shard._get_errors())
+            cleanup(task)
+
+        patches = [
+            mock.patch('osmosis.benchmark.BenchmarkImportTask.import_row',
+                       side_effect=lambda forms, cleaned_data: imported.append(cleaned_data["number"])),
+            mock.patch('osmosis.benchmark._cleanup', side_effect=record_errors),
+        ]
+        with nested(*patches):
+            results = run_benchmark(
+                rows=30, columns=3, error_rate=0.1, shard_source=ShardSource.BYTE_RANGE, bytes_per_shard=200
+            )
+
+        # The same rows generate_csv makes invalid
+        invalid = set(random.Random(0).sample(xrange(30), 3))
+        self.assertGreater(results["shards"], 1)
+        self.assertEqual(30, results["rows"])
+        self.assertEqual(sorted(set(xrange(30)) - invalid), sorted(imported))
+        # Numbered from the start of the file, not the start of each shard
+        self.assertEqual(sorted(row + 1 for row in invalid), sorted(error_lines))
+
+
+class ReaderTests(TestCase):
+    def test_reader_chosen_by_extension(self):
+        self.assertEqual(CSVReader, get_reader_class("upload/data.csv"))
+        self.assertEqual(GzipCSVReader, get_reader_class("upload/DATA.CSV.GZ"))
+        self.assertEqual(JSONLinesReader, get_reader_class("upload/data.jsonl"))
+        self.assertEqual(XLSXReader, get_reader_class("upload/data.xlsx"))
+        self.assertEqual(JSONLinesReader, get_reader_class("upload/data", "application/x-ndjson"))
+        self.assertEqual(CSVReader, get_reader_class("upload/data"))
+
+    def test_csv_dialect_sniffed_from_complete_lines(self):
+        source = StringIO.StringIO("a;b\n1;2\n3;4\n")
+        with mock.patch('osmosis.readers.csv.Sniffer') as mock_sniffer:
+            mock_sniffer.return_value.sniff.return_value = dialect_attributes({"delimiter": ";"})
+            reader = CSVReader(source, sample_size=10)
+
+        self.assertEqual("a;b\n1;2\n", mock_sniffer.return_value.sniff.call_args[0][0])
+        self.assertEqual(["a", "b"], reader.read_header())
+        self.assertEqual({"a": "1", "b": "2"}, reader.read_row())
+
+    def test_task_dialect_is_only_sniffed_once(self):
+        task = ImportTask(id=1)
+        source = StringIO.StringIO("a;b\n1;2\n")
+
+        with nested(
+            mock.patch('osmosis.models.ImportTask.objects.filter'),
+            mock.patch.object(ImportTask.Osmosis, 'dialect', {"delimiter": ";"}),
+            mock.patch('osmosis.readers.csv.Sniffer'),
+        ) as (_, _, mock_sniffer):
+            self.assertFalse(task.next_source_row(source))
+            self.assertEqual({"a": "1", "b": "2"}, task.next_source_row(source))
+
+            # The stored dialect is used when the override is removed
+            ImportTask.Osmosis.dialect = None
+            self.assertEqual(";", task.get_dialect()["delimiter"])
+
+        self.assertFalse(mock_sniffer.called)
+        self.assertEqual(["a", "b"], json.loads(task.detected_columns_json))
+
+    def test_gzip_csv_reader(self):
+        compressed = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as f:
+            f.write(TEST_FILE_ONE.getvalue())
+        compressed.seek(0)
+
+        reader = GzipCSVReader(compressed)
+        self.assertEqual(3, len(reader.read_header()))
+        self.assertEqual(5, len(read_all(reader)))
+
+    def test_json_lines_reader(self):
+        source = StringIO.StringIO('{"b": 1, "a": "x"}\n\n{"a": "y"}\n')
+        reader = JSONLinesReader(source)
+
+        self.assertEqual(["b", "a"], reader.read_header())
+        self.assertEqual(0, reader.position)
+        self.assertEqual([{"a": "x", "b": 1}, False, {"a": "y"}], read_all(reader))
+
+        # Any line break is a row boundary
+        self.assertEqual(19, reader.find_row_boundary(5))
+        self.assertEqual(20, reader.find_row_boundary(20))
+
+    def test_json_lines_which_arent_objects_are_row_errors(self):
+        reader = JSONLinesReader(StringIO.StringIO('{"a": "x"}\n{"a": \n[1, 2]\n'))
+        reader.read_header()
+
+        first, malformed, not_object = read_all(reader)
+        self.assertEqual({"a": "x"}, first)
+        self.assertEqual('{"a":', malformed["a"])
+        self.assertTrue(malformed[READ_ERROR_KEY].startswith("Invalid JSON"))
+        self.assertEqual({"a": "[1, 2]", READ_ERROR_KEY: "Not a JSON object"}, not_object)
+
+    def test_unreadable_rows_reported_as_errors(self):
+        task = ImportTask.objects.create(status=ImportStatus.IN_PROGRESS)
+        shard = ImportShard.objects.create(
+            task_id=task.pk, task_model_path=task.model_path, total_rows=2, start_line_number=1,
+            source_data_json=encode_rows([{"a": "1"}, {"a": "[1]", READ_ERROR_KEY: "Not a JSON object"}], ["a"])
+        )
+
+        patches = [
+            mock.patch('osmosis.models.ImportTask.defer'),
+            mock.patch('osmosis.models.ImportTask.import_row'),
+            mock.patch('osmosis.models.ImportShard.handle_error'),
+        ]
+        with nested(*patches) as (_, mock_import_row, mock_handle_error):
+            shard.process()
+
+        self.assertEqual(1, mock_import_row.call_count)
+        self.assertEqual(1, mock_handle_error.call_count)
+        self.assertEqual(2, mock_handle_error.call_args[0][0])
+        self.assertEqual(["Not a JSON object"], mock_handle_error.call_args[0][2])
+
+    @unittest.skipIf(openpyxl is None, "openpyxl isn't installed")
+    def test_xlsx_reader(self):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["name", "count", None])
+        sheet.append(["a", 1, None])
+        sheet.append([None, None, None])
+        sheet.append(["b", 2.5, None])
+        source = StringIO.StringIO()
+        workbook.save(source)
+        source.seek(0)
+
+        reader = XLSXReader(source)
+        self.assertEqual(["name", "count"], reader.read_header())
+        self.assertEqual(
+            [{"name": "a", "count": "1"}, {"name": "b", "count": "2.5"}],
+            [row for row in read_all(reader) if row is not False]
+        )
+
+
+class StorageTests(TestCase):
+    def setUp(self):
+        self.storage = LocalStorage(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.storage.root)
+
+    def test_local_storage_reads_ranges(self):
+        with self.storage.writer(self.storage.path("dir", "file.csv")) as f:
+            f.write("a,b\n1,2\n3,4\n")
+
+        with self.storage.open("dir/file.csv", 4, 8) as f:
+            self.assertEqual(4, f.tell())
+            self.assertEqual(["1,2\n"], list(iter(f.readline, "")))
+
+        with self.storage.open("dir/file.csv", 6, 10) as f:
+            self.assertEqual("2\n3,", f.read())
+
+    def test_local_storage_writer_discards_failed_writes(self):
+        with self.assertRaises(ValueError):
+            with self.storage.writer("file.csv") as f:
+                f.write("partial")
+                raise ValueError()
+
+        self.assertEqual([], os.listdir(self.storage.root))
+        self.storage.delete(["file.csv"])  # Missing files are ignored
+
+    def test_cloud_storage_composes_in_rounds(self):
+        storage = CloudStorage(bucket="bucket")
+        filenames = [storage.path("errors", "%s.csv" % i) for i in range(40)]
+
+        with nested(
+            mock.patch('cloudstorage.open', return_value=FakeCloudStorageFile()),
+            mock.patch('cloudstorage.compose', create=True),
+            mock.patch('cloudstorage.delete'),
+        ) as (_, mock_compose, mock_delete):
+            storage.compose(filenames, "/bucket/errors/all.csv", "header")
+
+        # The header and the first 31 files, then the rest
+        self.assertEqual(
+            [32, 9, 2],
+            [len(c[0][0]) for c in mock_compose.call_args_list]
+        )
+        self.assertEqual("errors/0.csv", mock_compose.call_args_list[0][0][0][1])
+        self.assertEqual("/bucket/errors/all.csv", mock_compose.call_args_list[-1][0][1])
+        self.assertEqual(
+            ["/bucket/errors/all.csv.header", "/bucket/errors/all.csv.part-0-0", "/bucket/errors/all.csv.part-1-32"],
+            sorted(c[0][0] for c in mock_delete.call_args_list)
+        )
+
+
+class FakeMemcache(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+
+    def add(self, key, value, time=0):
+        return not self.add_multi({key: value})
+
+    def add_multi(self, mapping, time=0, key_prefix=""):
+        not_added = []
+        for key, value in mapping.items():
+            if key_prefix + key in self.values:
+                not_added.append(key)
+            else:
+                self.values[key_prefix + key] = value
+        return not_added
+
+    def get_multi(self, keys, key_prefix=""):
+        return {key: self.values[key_prefix + key] for key in keys if key_prefix + key in self.values}
+
+    def delete_multi(self, keys, key_prefix=""):
+        for key in keys:
+            self.values.pop(key_prefix + key, None)
+
+
+class UniqueKeyTests(TestCase):
+    def test_existing_instances_found_in_one_batch(self):
+        shards = [
+            ImportShard.objects.create(task_id=i, task_model_path="osmosis.ImportTask", start_line_number=i)
+            for i in range(3)
+        ]
+        unique = UniqueKey(["task_id", "start_line_number"], ImportShard)
+
+        keys = [unique.key({"task_id": "1", "start_line_number": "1"}), unique.key({"task_id": "2", "start_line_number": "5"})]
+        self.assertEqual((1, 1), keys[0])
+        self.assertIsNone(unique.key({"task_id": "", "start_line_number": "1"}))
+        self.assertIsNone(unique.key({"task_id": "one", "start_line_number": "1"}))
+
+        existing = unique.existing(keys)
+        self.assertEqual({(1, 1): shards[1]}, existing)
+
+        class ShardForm(forms.ModelForm):
+            class Meta:
+                model = ImportShard
+                fields = ("task_id", "start_line_number")
+
+        form = ShardForm({"task_id": "1", "start_line_number": "1"})
+        unique.attach([form], existing[(1, 1)])
+        self.assertTrue(form.is_valid())
+        self.assertEqual(shards[1].pk, form.save().pk)
+
+    def test_duplicates_detected_across_shards(self):
+        task = ImportTask(id=1)
+        with mock.patch("osmosis.unique.memcache", FakeMemcache()):
+            first = DuplicateDetector(task, ImportShard(id=1))
+            second = DuplicateDetector(task, ImportShard(id=2))
+
+            # {row index: the line it duplicates}
+            self.assertEqual({2: 1}, first.check([(("a",), 0, 1), (("b",), 1, 2), (("a",), 2, 3)]))
+            self.assertEqual({0: 2}, second.check([(("b",), 0, 10), (("c",), 1, 11)]))
+
+            # A retry of the first shard doesn't clash with itself
+            self.assertEqual({}, DuplicateDetector(task, ImportShard(id=1)).check([(("b",), 1, 2)]))
+
+            # Rows handed to another shard are forgotten
+            second.release(1)
+            self.assertEqual({}, DuplicateDetector(task, ImportShard(id=3)).check([(("c",), 0, 11)]))
+
+            # The shards of a retried import can have rows with the same line number
+            retry = DuplicateDetector(task, ImportShard(id=4))
+            self.assertEqual({2: 5}, retry.check([(("d",), 0, 5), (("e",), 1, 5), (("d",), 2, 5)]))
+
+
+class PayloadTests(TestCase):
+    def test_rows_round_trip(self):
+        rows = [
+            {"a": "1", "b": "2"},
+            {"a": "3"},  # A short row
+            {"b": "4"},  # Not a prefix of the columns
+            {"a": "5\n6", "b": "7", "c": "8"},  # A column we weren't told about
+        ]
+        for compress in (False, True):
+            payload = encode_rows(rows, ["a", "b"], compress=compress)
+            self.assertEqual(["a", "b", "c"], decode_columns(payload))
+            self.assertEqual(rows, list(decode_rows(payload)))
+            self.assertEqual(rows[2:], list(decode_rows(payload, start=2)))
+
+    def test_legacy_payload(self):
+        payload = json.dumps([{"a": "1"}, {"a": "2"}])
+        self.assertEqual(["a"], decode_columns(payload))
+        self.assertEqual([{"a": "2"}], list(decode_rows(payload, start=1)))
+
+
 class FormTests(TestCase):
 
     def test_boolean_interpretation_mixin(self):
@@ -141,3 +1415,56 @@ class FormTests(TestCase):
                     form_value, expected_boolean,
                     failure_msg % (input_value, expected_boolean, form_value)
                 )
+
+    def test_form_prototype_matches_new_forms(self):
+        class ImportShardForm(BooleanInterpreterMixin, forms.ModelForm):
+            class Meta:
+                model = ImportShard
+                fields = ('complete', 'total_rows')
+
+        self.assertTrue(can_rebind(ImportShardForm))
+        prototype = FormPrototype(ImportShardForm)
+
+        rows = [
+            {'complete': 'false', 'total_rows': '3'},
+            {'complete': 'yes', 'total_rows': 'three'},
+            {'complete': '0', 'total_rows': '5'},
+        ]
+        bound = [prototype.bind(data) for data in rows]
+        for form, data in zip(bound, rows):
+            expected = ImportShardForm(data)
+            self.assertEqual(expected.is_valid(), form.is_valid())
+            self.assertEqual(expected.errors, form.errors)
+            self.assertEqual(getattr(expected, 'cleaned_data', None), getattr(form, 'cleaned_data', None))
+
+        # Each row gets its own instance to save
+        self.assertNotEqual(bound[0].instance, bound[2].instance)
+        self.assertEqual(3, bound[0].instance.total_rows)
+
+    def test_form_prototype_prefetches_lookups(self):
+        class LookupForm(forms.Form):
+            shard = forms.ModelChoiceField(queryset=ImportShard.objects.all())
+
+        shards = [ImportShard.objects.create(task_id=1, task_model_path="osmosis.ImportTask") for i in range(2)]
+        rows = [{'shard': str(shards[0].pk)}, {'shard': str(shards[1].pk)}, {'shard': str(shards[0].pk)}, {'shard': '999'}]
+
+        prototype = FormPrototype(LookupForm)
+        lookup = prototype.lookups[0]
+        prototype.prefetch(rows)
+        self.assertEqual(set([shards[0].pk, shards[1].pk, 999]), lookup.fetched)
+
+        with mock.patch.object(lookup, 'original_to_python', wraps=lookup.original_to_python) as to_python:
+            bound = [prototype(data) for data in rows]
+            self.assertEqual([True, True, True, False], [form.is_valid() for form in bound])
+            self.assertEqual(shards[1], bound[1].cleaned_data['shard'])
+            self.assertEqual(LookupForm(rows[3]).errors, bound[3].errors)
+
+        # Only the value which wasn't found goes to the database
+        to_python.assert_called_once_with('999')
+
+    def test_forms_with_custom_init_are_not_rebound(self):
+        class CustomForm(forms.Form):
+            def __init__(self, *args, **kwargs):
+                super(CustomForm, self).__init__(*args, **kwargs)
+
+        self.assertFalse(can_rebind(CustomForm))
@@ -0,0 +1,143 @@
+"""
+Support for Osmosis.unique_key, the columns which identify the entity a row
+is for. Shards look up the existing entities for a batch of rows at a time,
+so that rows update them rather than creating duplicates, and flag rows
+whose key has already been seen elsewhere in the file.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+from django import forms
+from django.core.exceptions import ValidationError
+
+from google.appengine.api import memcache
+
+from osmosis.forms import LOOKUP_BATCH_SIZE
+
+# How long the keys seen by an import are remembered for
+DUPLICATE_KEY_SECONDS = 24 * 60 * 60
+
+# Not a line number: which row keeps the key depends on which shard gets to it first, and
+# the shards of a file split with bytes_per_shard number their lines from their own start
+DUPLICATE_ERROR = "Duplicate of another row with the same key"
+
+
+class UniqueKey(object):
+    """
+    The values of `fields` in a row. If `model` is given the values are
+    converted by its fields, and existing() finds the instances with them.
+    """
+    def __init__(self, fields, model=None):
+        self.fields = list(fields)
+        self.model = model
+        self.model_fields = [model._meta.get_field(name) for name in self.fields] if model else []
+
+    def key(self, data):
+        """
+        The key of a row of source data, or None if it doesn't have one
+        """
+        values = []
+        for i, name in enumerate(self.fields):
+            value = data.get(name)
+            if value in forms.Field.empty_values:
+                return None
+            if self.model_fields:
+                try:
+                    value = self.model_fields[i].to_python(value)
+                except (ValidationError, TypeError, ValueError):
+                    return None
+            values.append(value)
+
+        key = tuple(values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def existing(self, keys):
+        """
+        Return {key: instance} for the keys which already exist, filtering on the first of
+        the fields with one query per LOOKUP_BATCH_SIZE values (or just one on the primary key)
+        """
+        keys = set(keys)
+        first = self.model_fields[0]
+        values = list(set(key[0] for key in keys))
+        batch_size = len(values) if first.primary_key else LOOKUP_BATCH_SIZE
+
+        found = {}
+        for i in xrange(0, len(values), batch_size or 1):
+            queryset = self.model._default_manager.filter(**{"%s__in" % first.name: values[i:i + batch_size]})
+            for instance in queryset:
+                key = tuple(getattr(instance, field.attname) for field in self.model_fields)
+                if key in keys:
+                    found[key] = instance
+        return found
+
+    def attach(self, row_forms, instance):
+        """
+        Make the row's model forms update `instance` rather than create a new one.
+        This must be done before they are validated.
+        """
+        for form in row_forms:
+            if isinstance(form, forms.BaseModelForm) and form._meta.model is self.model:
+                form.instance = instance
+
+
+class DuplicateDetector(object):
+    """
+    Finds rows with the same key across all the shards of an import. The first line seen with
+    each key is stored in memcache with add_multi, which is atomic, so whichever shard gets there
+    first keeps it and the other rows are duplicates. Memcache can evict the keys, so this is best
+    effort: a duplicate of a line which has been evicted isn't spotted.
+
+    Rows are identified by their index in the shard, as line numbers aren't unique within a shard
+    of a retried import.
+    """
+    def __init__(self, task, shard):
+        self.key_prefix = "osmosis-unique:%s:%s:" % (task.model_path, task.pk)
+        self.owner = shard.pk
+        self.seen = {}  # {key: (row, lineno)} of the rows this shard has checked
+        self.stored = {}  # {row: memcache key} of the keys this shard added
+
+    def _memcache_key(self, key):
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def check(self, rows):
+        """
+        Given a list of (key, row, lineno), return {row: the line it duplicates}
+        """
+        duplicates = {}
+        new = OrderedDict()
+        for key, row, lineno in rows:
+            first_row, first_lineno = self.seen.setdefault(key, (row, lineno))
+            if first_row != row:
+                duplicates[row] = first_lineno
+            else:
+                new[self._memcache_key(key)] = (self.owner, row, lineno)
+
+        if not new:
+            return duplicates
+
+        not_added = memcache.add_multi(new, time=DUPLICATE_KEY_SECONDS, key_prefix=self.key_prefix)
+        current = memcache.get_multi(not_added, key_prefix=self.key_prefix) if not_added else {}
+        for memcache_key, (owner, row, lineno) in new.items():
+            value = current.get(memcache_key)
+            if value is not None and tuple(value[:2]) != (owner, row):
+                duplicates[row] = value[-1]
+            else:
+                # Ours, possibly from an earlier attempt at this shard
+                self.stored[row] = memcache_key
+        return duplicates
+
+    def release(self, from_row):
+        """
+        Forget the keys of the rows from index `from_row` on, which have
+        been read ahead but are being handed to another shard
+        """
+        keys = [key for row, key in self.stored.items() if row >= from_row]
+        if keys:
+            memcache.delete_multi(keys, key_prefix=self.key_prefix)
+        self.stored = {row: key for row, key in self.stored.items() if row < from_row}
+        self.seen = {key: first for key, first in self.seen.items() if first[0] < from_row}